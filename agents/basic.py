@@ -1,18 +1,30 @@
 import json
-
-import openai
+import asyncio
+import traceback
+from concurrent.futures import as_completed
+import yaml
 import pandas as pd
 from bs4 import BeautifulSoup as bsoup
-from src.gpt_function import gpt_agent
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from src.gpt_function import gpt_agent, to_json
+from src.llm import get_llm_client
+from src.context import get_context_manager
+from src.event_loop import submit
+from data.profile import profile_dataframe
+import data.core as core
 import streamlit as st
 
 
-def describe_dataframe(name: str, data: pd.DataFrame):
+def describe_dataframe(name: str, data: pd.DataFrame, profile: dict = None):
     """
-    Extracts the important information from an html page.
-    :param text: the text to extract from
+    Generates a short description of a dataframe.
+    :param name: the name of the dataframe
+    :param data: the dataframe to describe
+    :param profile: the column profile of the dataframe, computed if not given
     """
 
+    if profile is None:
+        profile = profile_dataframe(data)
     columns = list(data.columns)
     rows = len(data)
     sample = data.head(3).to_json()
@@ -21,6 +33,7 @@ def describe_dataframe(name: str, data: pd.DataFrame):
         "name": name,
         "columns": columns,
         "n_rows": rows,
+        "profile": profile["columns"],
         "sample": sample
     }
     content = json.dumps(content, indent=4)
@@ -29,14 +42,15 @@ def describe_dataframe(name: str, data: pd.DataFrame):
     It should describe the contents of the dataframe in a way that is easy to understand. One sentence maximum
     The description should be maximally succinct, don't say things like 'This dataframe contains'"""
 
-    response = openai.ChatCompletion.create(
+    response = get_llm_client().complete(
+        "describe_dataframe",
         model="gpt-3.5-turbo-16k",
         messages=[
             {"role": "system", "content": prompt},
             {"role": "user", "content": content}
         ]
     )
-    return response["choices"][0]["message"]["content"]
+    return response["content"]
 
 
 def html_extract(text: str):
@@ -58,18 +72,147 @@ def html_extract(text: str):
 
     print(len(text))
 
-    response = openai.ChatCompletion.create(
+    response = get_llm_client().complete(
+        "html_extract",
         model="gpt-3.5-turbo-16k",
         messages=[
             {"role": "system", "content": "Extract the important information from this html page. Summarize when necessary."},
             {"role": "user", "content": text}
         ]
     )
-    return response["choices"][0]["message"]["content"]
+    return response["content"]
+
+
+def _summary_prompt(function_name: str, goal: str) -> str:
+    return f"""The function {function_name} has been called on several inputs.
+The goal is to {goal}.
+Your task is to extract the important information from the output of each call.
+I will give you a json list of the calls, each with its input and output.
+Your response must be a single json object with one string per call, in the same order as the calls:
+{{"outputs": ["output key data", "output key data"]}}
+For example for a weather function:
+{{"outputs": ["18 degrees, sunny, 10% chance of rain", "12 degrees, cloudy, 60% chance of rain"]}}
+Make sure each output contains all the information you need to complete the goal, and nothing else.
+Make sure the formatting is consistent."""
+
+
+def _describe_input(arg_set: dict) -> str:
+    """
+    Gets a short description of the input of a call, from the values of its arguments.
+    :param arg_set: the arguments of the call
+    """
+    return ", ".join(str(value) for value in arg_set.values())
+
+
+async def _call_limited(semaphore: asyncio.Semaphore, func, arg_set: dict, context) -> str:
+    """
+    Makes a single call of a function once the semaphore allows it.
+    The output is returned whole, it is combined with the others before anything is stored or sent to the LLM.
+    Errors are returned as the result, so that a failing call does not affect the others.
+    :param semaphore: limits the number of calls running at once
+    :param func: the function to call
+    :param arg_set: the arguments of the call
+    :param context: the script run context to make the call with
+    """
+    async with semaphore:
+        try:
+            return await func.acall(arg_set, context, raw=True)
+        except Exception as e:
+            traceback.print_exc()
+            return json.dumps({"error": f"The function '{func.name}' failed: {e}"})
+
+
+def _batches(items: list[int], sizes: list[int], max_tokens: int) -> list[list[int]]:
+    """
+    Splits items into consecutive batches of at most a number of tokens, each batch having at least one item.
+    :param items: the items
+    :param sizes: the tokens of each item
+    :param max_tokens: the maximum tokens of a batch
+    """
+    batches = []
+    batch, used = [], 0
+    for item, size in zip(items, sizes):
+        if batch and used + size > max_tokens:
+            batches.append(batch)
+            batch, used = [], 0
+        batch.append(item)
+        used += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _flatten(value, prefix: str, row: dict):
+    """
+    Flattens a value into the columns of a row. Nested objects become dotted column names,
+    lists of values are kept as JSON text so that every column has a single type.
+    :param value: the value to flatten
+    :param prefix: the column name of the value, empty at the top
+    :param row: the row to add the columns to
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(item, f"{prefix}.{key}" if prefix else str(key), row)
+    elif isinstance(value, list):
+        row[prefix or "output"] = to_json(value)
+    else:
+        row[prefix or "output"] = value
+
+
+def _to_rows(arg_set: dict, output) -> list[dict]:
+    """
+    Flattens the input and output of a call into rows.
+    An output that is a list of objects, like search results, gives one row per object.
+    Output columns with the same name as an argument are prefixed with 'output.'.
+    :param arg_set: the arguments of the call
+    :param output: the output of the call
+    """
+    items = output if isinstance(output, list) and output and all(isinstance(item, dict) for item in output) \
+        else [output]
+    rows = []
+    for item in items:
+        flat = {}
+        _flatten(item, "", flat)
+        row = {}
+        _flatten(arg_set, "", row)
+        for column, value in flat.items():
+            row[f"output.{column}" if column in row else column] = value
+        rows.append(row)
+    return rows
+
+
+def _save_table(function_name: str, goal: str, args: list[dict], outputs: list, name: str) -> dict:
+    """
+    Saves the results of the calls as a new dataset, one or more rows per call.
+    :param function_name: the name of the function that was called
+    :param goal: what the calls were for
+    :param args: the arguments of each call
+    :param outputs: the output of each call
+    :param name: the name to save the data as
+    :return: the name, profile and a preview of the data, for the LLM
+    """
+    rows = []
+    columns = {}
+    for arg_set, output in zip(args, outputs):
+        for row in _to_rows(arg_set, output):
+            rows.append(row)
+            columns.update(dict.fromkeys(row))
+    # Every row gets every column, in the order they were first seen, so the schema does not depend on the order
+    data = pd.DataFrame.from_records(rows, columns=list(columns))
+    core.save_new_data(data, name, f"The results of calling {function_name} on {len(args)} inputs to {goal}")
+    profile = core.get_data_profile(name)
+    errors = sum(1 for output in outputs if isinstance(output, dict) and "error" in output)
+    return {
+        "saved_as": name,
+        "rows": profile["rows"],
+        "failed_calls": errors,
+        "profile": profile["columns"],
+        "preview": json.loads(data.head(3).to_json(orient="records", date_format="iso")),
+    }
 
 
 @gpt_agent
-def run_on_list(function_name: str, args: list[str], goal: str):
+def run_on_list(function_name: str, args: list[dict], goal: str, save_as: str = ""):
     """
     Use this if you need to run a function multiple times on different arguments.
     So that you don't have to keep calling the same function over and over again.
@@ -79,50 +222,71 @@ def run_on_list(function_name: str, args: list[str], goal: str):
     :param args: a list of arguments for each call. For example:
     [{"arg1": "value1", "arg2": "value2"}, {"arg1": "value3", "arg2": "value4"}}]
     :param goal: a plain text description of what you want to do with this function.
+    :param save_as: a name to store all the results under as new data, as a table with a row per result, optional.
+    Use this for long lists, or when the results will be analyzed or plotted. Only the name, profile and a preview
+    of the data are returned then. Leave empty to get the results back directly.
     """
 
+    config = yaml.safe_load(open("config.yaml", "r"))["run_on_list"]
     func = st.session_state["conversator"].functions[function_name]
-    results = []
-
-    starter_prompt = f""" The function {function_name} is being called multiple times.
-    The goal is to {goal}.
-    Your task is to extact the important information from each call.
-    I will give you the input and output of each call and you will summarize it to be easier to read.
-    Your output must be formatted as follows:
-    {{"input": "input summary", "output": "output key data"}}
-    For examples for a weather function: 
-    {{"input": "London", "output": "18 degrees, sunny, 10% chance of rain"}}
-    Following standard json formatting.
-    Make sure the output contains all the information you need to complete the goal.
-    Make sure the input summary is as short as possible, only containing key identifying information.
-    For example if the input to the function is:
-    {{"origin": "Manchester, UK", "destination": "London, UK", "mode": "driving"}}
-    The summary should be:
-    {{"Manchester, UK to London, UK by driving"}}
-    Make sure the summary formatting is consistent.
-    """
-
-    messages = [{"role": "system", "content": starter_prompt}]
-    prev = "Working on it..."
-    for arg_set in args:
-        with st.spinner(prev):
-            args = json.loads(arg_set)
-            result = func(args)
-            new_msg = f"""function input: "{arg_set}", function output: "{result}" """
-            messages.append({"role": "user", "content": new_msg})
-            summarization = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=messages
-            )
-            summarization = summarization["choices"][0]["message"]["content"]
-            messages.append({"role": "assistant", "content": summarization})
-            results.append(summarization)
-        prev = json.loads(summarization)["input"]
+    counter = get_context_manager(config["model"])
+    context = get_script_run_ctx()
+    progress = st.progress(0.0, text="Working on it...")
+
+    # Make the calls concurrently, up to a limit, on the shared event loop
+    semaphore = asyncio.Semaphore(config["concurrency"])
+    futures = {submit(_call_limited(semaphore, func, arg_set, context)): index for index, arg_set in enumerate(args)}
+    outputs = [None] * len(args)
+    tokens = [0] * len(args)
+    for done, future in enumerate(as_completed(futures), start=1):
+        index = futures[future]
+        tokens[index] = counter.count_text(future.result())
+        outputs[index] = json.loads(future.result())
+        progress.progress(done / max(len(args), 1), text=f"{done}/{len(args)} done: {_describe_input(args[index])}")
+
+    if save_as:
+        progress.empty()
+        return _save_table(function_name, goal, args, outputs, save_as)
 
+    # Results that are already short, and errors, are returned as they are, the rest are summarized in batches
+    to_summarize = [index for index, output in enumerate(outputs)
+                    if tokens[index] > config["compact_tokens"] and not (isinstance(output, dict) and "error" in output)]
+    batches = _batches(to_summarize, [tokens[index] for index in to_summarize], config["batch_tokens"])
+
+    if batches:
+        progress.progress(1.0, text=f"Summarizing {len(to_summarize)} results...")
+        summaries = [submit(get_llm_client().acomplete(
+            "run_on_list",
+            model=config["model"],
+            messages=[
+                {"role": "system", "content": _summary_prompt(function_name, goal)},
+                {"role": "user", "content": to_json([
+                    {"input": args[index], "output": outputs[index]} for index in batch
+                ])}
+            ]
+        )) for batch in batches]
+        for batch, summary in zip(batches, summaries):
+            try:
+                summarized = json.loads(summary.result()["content"])["outputs"]
+                if len(summarized) != len(batch):
+                    raise ValueError(f"{len(summarized)} summaries for {len(batch)} results")
+            except Exception:
+                # The results of a batch that could not be summarized are returned whole
+                traceback.print_exc()
+                continue
+            for index, output in zip(batch, summarized):
+                outputs[index] = output
+    progress.empty()
+
+    results = [{"input": _describe_input(arg_set), "output": output} for arg_set, output in zip(args, outputs)]
     print(results)
     return results
 
 
+# The results can be saved to the data store
+run_on_list.uses_data = True
+
+
 if __name__ == '__main__':
     args = {
         "function_name": "get_travel_distance",
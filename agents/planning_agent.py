@@ -1,8 +1,9 @@
 import yaml
-import openai
 import json
 import streamlit as st
-from secret import keys
+from src.context import get_context_manager
+from src.tool_registry import get_tool_registry
+from src.llm import get_llm_client
 from src.gpt_function import GPTFunction, gpt_agent
 from functions.gmaps import get_travel_distance
 from agents.basic import run_on_list
@@ -103,25 +104,31 @@ Make sure the response is well structured."""
 
 class PlanningAgent:
     def __init__(self, functions: list[GPTFunction]):
-        openai.api_key = keys.openai_key
         config = yaml.safe_load(open("config.yaml", "r"))
         self.model_name = config["model"]["agent"]
         self.messages = []
+        # Keeps the messages sent within the token budget of the model
+        self.context = get_context_manager(self.model_name)
         self.functions = {}
         self.max_retries = 3
         for function in functions:
             self.functions[function.name] = function
+        self.registry = get_tool_registry(list(self.functions.values()), self.context.count_text)
 
     def get_response(self, prompt: str, allow_function_calls: bool = True):
         print("\nSystem:")
         print(prompt)
         self.messages.append({"role": "system", "content": prompt})
-        response = openai.ChatCompletion.create(
+        # Planning needs to know every function, only the relevant ones are sent once calls are allowed
+        names = self.registry.select(self.messages) if allow_function_calls else list(self.functions)
+        functions = self.registry.function_schemas(names)
+        response = get_llm_client().complete(
+            "planning_agent",
             model=self.model_name,
-            messages=self.messages,
-            functions=list(map(lambda x: x.to_dict(), self.functions.values())),
+            messages=self.context.fit(self.messages, function_tokens=self.registry.count(names)),
+            functions=functions,
             function_call="auto" if allow_function_calls else "none"
-        )["choices"][0]["message"]
+        )
         self.messages.append(response)
 
         if response.get("function_call") and allow_function_calls:
@@ -225,6 +232,10 @@ def complete_task(task: str):
     return {"result": agent.run(task)}
 
 
+# The agent may call any of the data functions
+complete_task.uses_data = True
+
+
 if __name__ == '__main__':
     functions = [
         get_travel_distance,
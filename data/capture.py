@@ -0,0 +1,110 @@
+import re
+import json
+import threading
+import traceback
+import pandas as pd
+import streamlit as st
+import yaml
+import data.core as core
+from src.context import get_token_counter
+
+# Calls run in parallel, so choosing a free name and saving the data under it must not interleave
+_save_lock = threading.Lock()
+
+
+def _as_table(value, min_rows: int) -> pd.DataFrame | None:
+    """
+    Converts a value to a table if it is shaped like one,
+    either a list of objects or an object of lists of the same length, with at least a number of rows.
+    :param value: the value
+    :param min_rows: the minimum number of rows
+    :return: the table, or None if the value is not shaped like a table
+    """
+    if isinstance(value, list) and len(value) >= min_rows and all(isinstance(item, dict) for item in value):
+        return pd.json_normalize(value, sep=".")
+    if isinstance(value, dict) and len(value) >= 2 and all(isinstance(item, list) for item in value.values()):
+        lengths = {len(item) for item in value.values()}
+        if len(lengths) == 1 and lengths.pop() >= min_rows:
+            return pd.DataFrame(value)
+    return None
+
+
+def find_table(result, min_rows: int) -> tuple[pd.DataFrame, str | None] | None:
+    """
+    Finds a table in the result of a function, either the whole result or one of its top level values.
+    :param result: the result
+    :param min_rows: the minimum number of rows of a table
+    :return: the table and the key it was found under, None for the whole result, or None if there is no table
+    """
+    table = _as_table(result, min_rows)
+    if table is not None:
+        return table, None
+    if isinstance(result, dict):
+        for key, value in result.items():
+            table = _as_table(value, min_rows)
+            if table is not None:
+                return table, key
+    return None
+
+
+def _new_name(function_name: str) -> str:
+    """
+    Get a name for captured data that is not used yet, e.g. 'weather_2' for get_weather.
+    :param function_name: the name of the function the data came from
+    :return: the name
+    """
+    base = re.sub(r"^(get|search|lookup)_", "", function_name)
+    index = 1
+    while f"{base}_{index}" in st.session_state["data"]:
+        index += 1
+    return f"{base}_{index}"
+
+
+def capture_tables(function_name: str, args: dict, result):
+    """
+    Stores a large table in the result of a function as new data, and replaces it in the result with a handle.
+    The handle has the name of the data, its size, columns and a preview, so that the LLM can work on the data
+    with the data functions instead of reading it whole or writing it out again to store it.
+    Results that are small, not shaped like a table, or from functions excluded in the config are left as they are.
+    :param function_name: the name of the function
+    :param args: the arguments the function was called with
+    :param result: the result of the function
+    :return: the result, with the table replaced by the handle if it was captured
+    """
+    config = yaml.safe_load(open("config.yaml", "r"))["capture"]
+    if not config["enabled"] or function_name in config["exclude"]:
+        return result
+    try:
+        found = find_table(result, config["min_rows"])
+        if found is None:
+            return result
+        table, key = found
+        text = json.dumps(result, separators=(",", ":"), default=str)
+        if get_token_counter().count_text(text) < config["min_tokens"]:
+            return result
+
+        # Lists inside the cells are kept as text, so that every column has a single type
+        for column in table.columns:
+            if table[column].map(lambda value: isinstance(value, (list, dict))).any():
+                table[column] = table[column].map(
+                    lambda value: json.dumps(value, default=str) if isinstance(value, (list, dict)) else value)
+        arguments = ", ".join(f"{arg}={value}" for arg, value in args.items())
+        with _save_lock:
+            name = _new_name(function_name)
+            core.save_new_data(table, name, f"The result of {function_name}({arguments})")
+        handle = {
+            "saved_as": name,
+            "rows": len(table),
+            "columns": list(table.columns),
+            "preview": json.loads(table.head(config["preview_rows"]).to_json(orient="records", date_format="iso")),
+            "note": f"The full table was stored as the data '{name}'. "
+                    f"Use query_data, analyze_data or plot_data on it instead of asking for it again.",
+        }
+        print(f"\nCaptured a table of {len(table)} rows from {function_name} as '{name}'")
+    except Exception:
+        # Capturing is only an optimization, the result is returned whole if it fails
+        traceback.print_exc()
+        return result
+    if key is None:
+        return handle
+    return {**result, key: handle}
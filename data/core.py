@@ -1,72 +1,190 @@
 import streamlit as st
 import pandas as pd
-from collections import deque
+import uuid
+import yaml
+import threading
+import traceback
+from data.lineage import Lineage
+from data.ingest import optimize_dtypes
+from data.workers import get_pool
+from data.workspace import get_workspaces
 
 
-def save_new_data(data: pd.DataFrame, name: str, summary: str):
+def get_session_id() -> str:
     """
-    Creates a new memory queue in the session state and saves the data to it.
+    Get the id of the current session, creating it if needed.
+    :return: the id of the session
+    """
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
+    return st.session_state["session_id"]
+
+
+def _recompute(name: str) -> callable:
+    """
+    Creates a function that reruns the transformation of a version on the data of its parent.
+    :param name: the name of the data
+    :return: the recompute function for the lineage of the data
+    """
+    def recompute(node: dict, data: pd.DataFrame) -> pd.DataFrame:
+        session = get_session_id()
+        with get_workspaces().call(session) as workdir:
+            output = get_pool().run(session, workdir, node["code"], name, data, node["parent"],
+                                    result_name=node["result_name"], filename="temp/transformation.py")
+        if output["result"] is None:
+            raise RuntimeError(f"Could not recompute a version of '{name}':\n{output['stderr']}")
+        # Convert the dtypes the same way as when the version was first stored
+        return _ingest(output["result"], yaml.safe_load(open("config.yaml", "r"))["data"])[0]
+    return recompute
+
+
+def _ingest(data: pd.DataFrame, config: dict) -> tuple[pd.DataFrame, dict]:
+    """
+    Converts incoming data to memory-compact dtypes if enabled in the config.
+    :param data: the incoming data
+    :param config: the data config
+    :return: the converted data and a report of the memory saved
+    """
+    if not config["optimize_dtypes"]:
+        return data, None
+    data, report = optimize_dtypes(data, arrow_strings=config["arrow_strings"],
+                                   categories=config["categories"],
+                                   downcast_numbers=config["downcast_numbers"])
+    print(f"\nIngested data: {report['before_mb']}MB -> {report['after_mb']}MB, converted {report['converted']}")
+    return data, report
+
+
+def save_new_data(data: pd.DataFrame, name: str, summary: str, profile: dict = None) -> dict | None:
+    """
+    Creates a new version history in the session state and saves the data to it.
     :param data: the data in a dataframe to save
     :param name: the name of the data
     :param summary: the summary of the data
+    :param profile: the column profile of the data, if it was already computed
+    :return: a report of the memory saved by converting the dtypes, or None if that is disabled
     """
-    st.session_state["data"][name] = deque(maxlen=5)
-    st.session_state["data"][name].append({"data": data, "summary": summary, "columns": list(data.columns)})
+    config = yaml.safe_load(open("config.yaml", "r"))["data"]
+    data, report = _ingest(data, config)
+    if report is not None and report["converted"]:
+        # The dtypes in a precomputed profile are no longer correct
+        profile = None
+    if name in st.session_state["data"]:
+        st.session_state["data"][name].close()
+    st.session_state["data"][name] = Lineage(data, summary, budget_mb=config["version_budget_mb"],
+                                             profile=profile)
+    return report
 
 
-def update_data(data: pd.DataFrame, name: str):
+def update_data(data: pd.DataFrame, name: str, code: str = None, result_name: str = None) -> dict | None:
     """
-    Adds a new version of the data to the queue in the session state.
+    Adds a new version of the data to its history in the session state.
+    Versions that come with the code that produced them can be evicted and recomputed later.
     :param data: the data in a dataframe
     :param name: the name of the data
+    :param code: the transformation code that produced the data from the previous version
+    :param result_name: the name the code assigns the transformed data to
+    :return: a report of the memory saved by converting the dtypes, or None if that is disabled
+    """
+    config = yaml.safe_load(open("config.yaml", "r"))["data"]
+    data, report = _ingest(data, config)
+    st.session_state["data"][name].append(data, code, result_name)
+    return report
+
+
+def summarize_async(name: str, summarize: callable):
+    """
+    Fills in the summary of the data in a background thread, so that the data can be used straight away.
+    :param name: the name of the data
+    :param summarize: a function generating the summary from the name, the data and its column profile
     """
-    old_summary = st.session_state["data"][name][-1]["summary"]
-    st.session_state["data"][name].append({"data": data, "summary": old_summary, "columns": list(data.columns)})
+    lineage = st.session_state["data"][name]
+
+    def run():
+        try:
+            lineage.summary = summarize(name, lineage.data, lineage.profile)
+        except Exception:
+            traceback.print_exc()
+            lineage.summary = "No summary available."
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def preload_data(name: str):
+    """
+    Loads the latest version of the data into the session's worker, so that code run on it later starts straight away.
+    :param name: the name of the data
+    """
+    data = get_data(name)
+    if data is None:
+        return
+    session = get_session_id()
+    with get_workspaces().call(session) as workdir:
+        get_pool().run(session, workdir, "", name, data, get_data_version(name), filename="temp/preload.py")
 
 
 def undo_data(name: str) -> bool | None:
     """
-    Removes the last version of the data from the queue in the session state.
+    Removes the last version of the data from its history in the session state.
     Only does so if there is more than one version of the data.
     :param name: the name of the data
     :return: True if the data was removed, False if there was only one version of the data, None if the data does not exist
     """
     if name not in st.session_state["data"]:
         return None
-    if len(st.session_state["data"][name]) == 1:
-        return False
-    st.session_state["data"][name].pop()
-    return True
+    return st.session_state["data"][name].undo(_recompute(name))
 
 
 def get_data(name: str) -> pd.DataFrame | None:
     """
-    Get the latest version of the data from the queue in the session state.
+    Get the latest version of the data from its history in the session state.
     :param name: the name of the data
     :return: the latest version of the data, or None if the data does not exist
     """
     if name not in st.session_state["data"]:
         return None
-    return st.session_state["data"][name][-1]["data"]
+    return st.session_state["data"][name].data
+
+
+def get_data_version(name: str) -> str | None:
+    """
+    Get the id of the latest version of the data.
+    :param name: the name of the data
+    :return: the id of the latest version of the data, or None if the data does not exist
+    """
+    if name not in st.session_state["data"]:
+        return None
+    return st.session_state["data"][name].head["version"]
 
 
 def get_data_details(name: str) -> dict | None:
     """
-    Get the details of the latest version of the data from the queue in the session state.
+    Get the details of the latest version of the data from its history in the session state.
     :param name: the name of the data
     :return: the details of the latest version of the data, or None if the data does not exist
     """
     if name not in st.session_state["data"]:
         return None
-    return st.session_state["data"][name][-1]
+    return st.session_state["data"][name].details()
+
+
+def get_data_profile(name: str) -> dict | None:
+    """
+    Get the column profile of the latest version of the data.
+    The profile is computed once per version and cached with it.
+    :param name: the name of the data
+    :return: the profile of the latest version of the data, or None if the data does not exist
+    """
+    if name not in st.session_state["data"]:
+        return None
+    return st.session_state["data"][name].profile
 
 
 def get_all_data_details() -> dict:
     """
-    Get the details of all the data from the queue in the session state.
+    Get the details of all the data from the session state.
     :return: the details of all the data
     """
     all_data = {}
     for name in st.session_state["data"]:
-        all_data[name] = st.session_state["data"][name][-1]
+        all_data[name] = st.session_state["data"][name].details()
     return all_data
@@ -0,0 +1,221 @@
+import re
+import numpy as np
+import pandas as pd
+
+# Strings with fewer distinct values than this fraction of their rows become categoricals
+_CATEGORY_RATIO = 0.5
+# The number of values looked at to decide if a column holds dates
+_DATE_SAMPLE = 100
+_DATE_PATTERN = re.compile(r"^\s*(\d{4}[-/.]\d{1,2}[-/.]\d{1,2}|\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4})([ T]\d{1,2}:\d{2}(:\d{2})?)?")
+# The orders of the day, month and year a date may be written in
+_DATE_ORDERS = [("%Y", "%m", "%d"), ("%d", "%m", "%Y"), ("%m", "%d", "%Y"), ("%d", "%m", "%y"), ("%m", "%d", "%y")]
+
+
+def _memory_mb(data: pd.DataFrame) -> float:
+    return float(data.memory_usage(index=True, deep=True).sum()) / (1024 * 1024)
+
+
+def _optimize_integers(column: pd.Series) -> pd.Series:
+    """
+    Downcasts a 64 bit integer column to 32 bits if it holds its values.
+    Nullable columns stay nullable. Arithmetic on the downcast column is 32 bit and silently wraps around
+    past about 2.1 billion, e.g. when multiplying or summing large values, so this is only done when enabled.
+    """
+    if column.dtype not in (np.int64, "Int64") or column.count() == 0:
+        return column
+    if np.iinfo(np.int32).min <= column.min() and column.max() <= np.iinfo(np.int32).max:
+        # Nullable integers stay nullable
+        return column.astype(np.int32 if column.dtype == np.int64 else "Int32")
+    return column
+
+
+def _optimize_floats(column: pd.Series) -> pd.Series:
+    """
+    Downcasts a float column to 32 bits, but only if no value changes.
+    Sums and means of the downcast column lose precision, so this is only done when enabled.
+    """
+    downcast = column.astype(np.float32)
+    if ((downcast.astype(np.float64) == column) | column.isna()).all():
+        return downcast
+    return column
+
+
+def _looks_like_dates(values: pd.Series) -> bool:
+    """
+    Checks if a sample of string values all look like dates.
+    """
+    sample = values.head(_DATE_SAMPLE)
+    return len(sample) > 0 and sample.map(lambda x: bool(_DATE_PATTERN.match(x))).all()
+
+
+def _date_format(values: pd.Series) -> str | None:
+    """
+    Infers the format of a column of date strings.
+    Every order of day, month and year is tried with the separators of the first value, and a format is only
+    returned if it is the single one that parses every value exactly. Dates that could be read either way,
+    e.g. '03/04/2023' when no day is over 12, are ambiguous and get no format.
+    :param values: the date strings, without missing values
+    :return: the format, or None if there is no single format that fits
+    """
+    first = values.iloc[0].strip()
+    match = _DATE_PATTERN.match(first)
+    date = match.group(1)
+    separator = re.search(r"[-/.]", date).group(0)
+    time = ""
+    if match.group(2):
+        time = match.group(2)[0] + ("%H:%M:%S" if match.group(3) else "%H:%M")
+    stripped = values.str.strip()
+    fitting = []
+    for order in _DATE_ORDERS:
+        if (len(date.split(separator)[0]) == 4) != (order[0] == "%Y"):
+            continue
+        date_format = separator.join(order) + time
+        # The format has to match each value whole, so a value parses only if it round-trips through the format
+        if pd.to_datetime(stripped, format=date_format, errors="coerce").notna().all():
+            fitting.append(date_format)
+    return fitting[0] if len(fitting) == 1 else None
+
+
+def _optimize_strings(column: pd.Series, arrow_strings: bool, categories: bool) -> pd.Series:
+    """
+    Converts a column of strings to dates, a categorical or an arrow string column.
+    """
+    values = column.dropna()
+    if pd.api.types.infer_dtype(values, skipna=True) != "string":
+        return column
+    if _looks_like_dates(values):
+        date_format = _date_format(values)
+        if date_format is not None:
+            return pd.to_datetime(column.str.strip(), format=date_format)
+    if categories and len(values) and values.nunique() <= _CATEGORY_RATIO * len(values):
+        return column.astype("category")
+    if arrow_strings:
+        return column.astype("string[pyarrow]")
+    return column
+
+
+def optimize_dtypes(data: pd.DataFrame, arrow_strings: bool = False, categories: bool = False,
+                    downcast_numbers: bool = False) -> tuple[pd.DataFrame, dict]:
+    """
+    Converts the columns of a dataframe to more memory-compact types.
+    Date strings in a single unambiguous format are parsed to dates. Numbers can optionally be downcast to 32 bits,
+    though generated code then gets 32 bit arithmetic on them. Low-cardinality strings can optionally become
+    categoricals, though generated code then cannot assign values outside the categories, e.g. with fillna,
+    and other strings can optionally be stored as arrow strings.
+    :param data: the dataframe to optimize
+    :param arrow_strings: whether to store the remaining strings as arrow strings
+    :param categories: whether to store low-cardinality strings as categoricals
+    :param downcast_numbers: whether to downcast integers and floats to 32 bits
+    :return: the optimized dataframe and a report of the memory saved and the columns converted
+    """
+    before = _memory_mb(data)
+    columns = []
+    converted = {}
+    for index, name in enumerate(data.columns):
+        column = data.iloc[:, index]
+        if pd.api.types.is_bool_dtype(column):
+            new = column
+        elif pd.api.types.is_integer_dtype(column):
+            new = _optimize_integers(column) if downcast_numbers else column
+        elif pd.api.types.is_float_dtype(column) and column.dtype == np.float64:
+            new = _optimize_floats(column) if downcast_numbers else column
+        elif column.dtype == object or pd.api.types.is_string_dtype(column) and \
+                not isinstance(column.dtype, pd.CategoricalDtype):
+            new = _optimize_strings(column, arrow_strings, categories)
+        else:
+            new = column
+        if new.dtype != column.dtype:
+            converted[str(name)] = f"{column.dtype} -> {new.dtype}"
+        columns.append(new)
+
+    if converted:
+        data = pd.concat(columns, axis=1)
+        data.columns = [column.name for column in columns]
+    after = _memory_mb(data)
+    return data, {
+        "before_mb": round(before, 3),
+        "after_mb": round(after, 3),
+        "saved_mb": round(before - after, 3),
+        "converted": converted,
+    }
+
+
+def _downcast_numbers(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcasts the integer and float columns of a dataframe, leaving the other columns as they are.
+    Unlike the string conversions this is safe per chunk: chunks that downcast differently are upcast again
+    to a common dtype when they are concatenated, without changing any value.
+    :param data: the dataframe
+    :return: the dataframe with its numbers downcast
+    """
+    for name in data.columns:
+        column = data[name]
+        if pd.api.types.is_bool_dtype(column):
+            continue
+        if pd.api.types.is_integer_dtype(column):
+            data[name] = _optimize_integers(column)
+        elif column.dtype == np.float64:
+            data[name] = _optimize_floats(column)
+    return data
+
+
+def _sample_dtypes(sample: pd.DataFrame) -> dict:
+    """
+    Chooses the dtypes to parse a csv with from a sample of its rows.
+    Integer and boolean columns use nullable dtypes, so missing values later in the file do not break them.
+    :param sample: the first rows of the csv
+    :return: the dtype of each column
+    """
+    dtypes = {}
+    for name in sample.columns:
+        column = sample[name]
+        if pd.api.types.is_bool_dtype(column):
+            dtypes[name] = "boolean"
+        elif pd.api.types.is_integer_dtype(column):
+            dtypes[name] = "Int64"
+        elif pd.api.types.is_float_dtype(column):
+            dtypes[name] = "float64"
+        else:
+            dtypes[name] = "object"
+    return dtypes
+
+
+def read_csv_chunked(file, progress: callable = None, chunk_rows: int = 100_000,
+                     sample_rows: int = 10_000, downcast: bool = False) -> pd.DataFrame:
+    """
+    Reads a csv in chunks, with the dtypes inferred from a sample of the first rows.
+    Falls back to letting pandas infer the dtypes if a later chunk does not fit the sampled ones.
+    All the chunks are held until they are concatenated at the end, so the peak memory is about twice the size
+    of the dataframe. Downcasting the numbers of each chunk as it is read lowers that peak,
+    the other dtype conversions are left to when the data is stored.
+    :param file: the csv file, must be seekable
+    :param progress: called with the fraction of the file read after each chunk
+    :param chunk_rows: the number of rows per chunk
+    :param sample_rows: the number of rows used to infer the dtypes
+    :param downcast: whether to downcast the numbers of each chunk
+    :return: the dataframe
+    """
+    file.seek(0, 2)
+    size = max(file.tell(), 1)
+    file.seek(0)
+    dtypes = _sample_dtypes(pd.read_csv(file, nrows=sample_rows))
+
+    for attempt_dtypes in (dtypes, None):
+        file.seek(0)
+        chunks = []
+        try:
+            for chunk in pd.read_csv(file, dtype=attempt_dtypes, chunksize=chunk_rows):
+                chunks.append(_downcast_numbers(chunk) if downcast else chunk)
+                if progress is not None:
+                    progress(min(file.tell() / size, 1.0))
+        except (ValueError, TypeError):
+            if attempt_dtypes is None:
+                raise
+            continue
+        break
+
+    if progress is not None:
+        progress(1.0)
+    if not chunks:
+        return pd.DataFrame(columns=list(dtypes))
+    return pd.concat(chunks, ignore_index=True)
@@ -0,0 +1,173 @@
+import uuid
+import weakref
+import pandas as pd
+from data.spill import get_store
+from data.profile import profile_dataframe
+
+
+def _size_mb(data: pd.DataFrame) -> float:
+    """
+    Get the memory used by a dataframe.
+    :param data: the dataframe
+    :return: the memory used in MB
+    """
+    return float(data.memory_usage(index=True, deep=True).sum()) / (1024 * 1024)
+
+
+class Lineage:
+    """
+    The version history of a single dataset.
+    Each version is a node holding the transformation code that produced it and a reference to its parent.
+    Only the original, the head and checkpoints that fit in the memory budget keep their data,
+    the other versions are recomputed from their closest kept ancestor when they are needed again.
+    The kept data lives in the process-wide store, which may spill it to disk.
+    """
+
+    def __init__(self, data: pd.DataFrame, summary: str, budget_mb: float = 1024, profile: dict = None):
+        self.summary = summary
+        self.budget_mb = budget_mb
+        self.store = get_store()
+        self.nodes = []
+        # The versions with data in the store, released when the lineage is closed or garbage collected
+        self.kept = set()
+        self._finalizer = weakref.finalize(self, self.store.discard_all, self.kept)
+        self._add_node(data, parent=None, code=None, result_name=None)
+        self.head["profile"] = profile
+
+    def _add_node(self, data: pd.DataFrame, parent: str | None, code: str | None, result_name: str | None):
+        """
+        Creates a new version node and puts its data in the store.
+        Versions without code cannot be recomputed, so they always keep their data.
+        :param data: the data of the version
+        :param parent: the id of the parent version
+        :param code: the transformation code that produced this version from its parent
+        :param result_name: the name the code assigns the transformed data to
+        """
+        node = {
+            "version": uuid.uuid4().hex,
+            "parent": parent,
+            "code": code,
+            "result_name": result_name,
+            "pinned": code is None,
+            "columns": list(data.columns),
+            "rows": len(data),
+            "size_mb": _size_mb(data),
+            "profile": None,
+        }
+        self.nodes.append(node)
+        self._keep(node, data)
+
+    def _keep(self, node: dict, data: pd.DataFrame):
+        """
+        Puts the data of a node in the store.
+        :param node: the node
+        :param data: the data of the node
+        """
+        self.store.put(node["version"], data, node["size_mb"])
+        self.kept.add(node["version"])
+
+    def _drop(self, node: dict):
+        """
+        Removes the data of a node from the store.
+        :param node: the node
+        """
+        self.store.discard(node["version"])
+        self.kept.discard(node["version"])
+
+    @property
+    def head(self) -> dict:
+        return self.nodes[-1]
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """
+        The data of the head version.
+        """
+        return self.store.get(self.head["version"])
+
+    @property
+    def profile(self) -> dict:
+        """
+        The column profile of the head version, computed the first time it is needed.
+        """
+        if self.head["profile"] is None:
+            self.head["profile"] = profile_dataframe(self.data)
+        return self.head["profile"]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def append(self, data: pd.DataFrame, code: str = None, result_name: str = None):
+        """
+        Adds a new version on top of the head.
+        :param data: the data of the new version
+        :param code: the transformation code that produced the data from the head
+        :param result_name: the name the code assigns the transformed data to
+        """
+        self._add_node(data, self.head["version"], code, result_name)
+        self._enforce_budget()
+
+    def undo(self, recompute: callable) -> bool:
+        """
+        Removes the head, making its parent the head again.
+        :param recompute: a function that reruns the code of a node on the data of its parent
+        :return: True if the head was removed, False if only the original version is left
+        """
+        if len(self.nodes) == 1:
+            return False
+        # Recompute the parent before removing the head, so a failed recompute leaves the history as it was
+        self.materialize(len(self.nodes) - 2, recompute)
+        self._drop(self.nodes.pop())
+        self._enforce_budget()
+        return True
+
+    def materialize(self, index: int, recompute: callable) -> pd.DataFrame:
+        """
+        Gets the data of a version, recomputing it from its closest kept ancestor if it was evicted.
+        Recomputed intermediate versions are not kept, only the requested one is.
+        :param index: the index of the version
+        :param recompute: a function that reruns the code of a node on the data of its parent
+        :return: the data of the version
+        """
+        start = index
+        while not self.store.has(self.nodes[start]["version"]):
+            start -= 1
+        data = self.store.get(self.nodes[start]["version"])
+        for node in self.nodes[start + 1:index + 1]:
+            data = recompute(node, data)
+        if start != index:
+            self._keep(self.nodes[index], data)
+        return data
+
+    def _enforce_budget(self):
+        """
+        Evicts the data of intermediate versions until the kept versions fit in the memory budget.
+        The original, the head and pinned versions are always kept, the newest checkpoints are preferred.
+        """
+        used = sum(node["size_mb"] for node in self.nodes if node["version"] in self.kept and
+                   (node["pinned"] or node is self.head))
+        for node in reversed(self.nodes[:-1]):
+            if node["pinned"] or node["version"] not in self.kept:
+                continue
+            if used + node["size_mb"] <= self.budget_mb:
+                used += node["size_mb"]
+            else:
+                self._drop(node)
+
+    def close(self):
+        """
+        Removes the data of all the versions from the store.
+        """
+        self._finalizer()
+
+    def details(self) -> dict:
+        """
+        Get the details of the head version.
+        :return: the data, summary, columns and version id of the head
+        """
+        return {
+            "data": self.data,
+            "summary": self.summary,
+            "columns": self.head["columns"],
+            "version": self.head["version"],
+        }
@@ -1,62 +1,53 @@
 from src.gpt_function import gpt_function
-import os
-from subprocess import Popen, PIPE
 import data.core as core
-import pandas as pd
+from data.workers import get_pool
+from data.workspace import get_workspaces
 import json
 import re
-from time import sleep
-import codecs
 
 
 @gpt_function
-def analyze_data(analysis_code: str, data_name: str):
+def analyze_data(data_name: str, analysis_code: str):
     """
     Useful for analyzing data, extracting statistics. Answering questions about the data. The data is a pandas dataframe.
     Before calling this function ALWAYS call 'get_data_details' to understand the structure of the data.
     DO NOT use this for changing or transforming the data. Use 'transform_data' for that.
     This cannot be used to filter, sort or prune the data. Use 'transform_data' for that.
-    :param analysis_code: the python code to be used to analyze the data. Load the data from a csv file.
+    :param data_name: the name of the data to be analyzed.
+    :param analysis_code: the python code to be used to analyze the data.
+    The data is already loaded as a pandas dataframe called "df", also available as "data" and under the data name.
+    pd, np and math are already imported. Do not read or write any files.
     Put all of the results you need in a json called "result". There must be a single varible called "result"
     and it must be a dictionary of all the results you need.
     This should be the code and just the code, do not add any additional comments or text.
     Make sure to only use columns that are specified in the data. Remember, they can be slightly different from the user input!
     Think about what columns are needed and not what exactly the user inputted.
-    :param data_name: the name of the data to be analyzed.
     """
 
     # Remove all import lines and lines that attempt to read a file
+    # The worker already has the libraries imported and the data bound to 'data', 'df' and the data name
     analysis_code = re.sub(r"import.*\n", "", analysis_code)
-    analysis_code = re.sub(r"= pd.read.*\n", "= pd.read_csv('temp/data.csv')", analysis_code)
+    analysis_code = re.sub(r"pd\.read_\w+\([^)]*\)", "_data", analysis_code)
 
-    # Save the data to a csv file
-    os.makedirs("temp", exist_ok=True)
     data = core.get_data(data_name)
     if data is None:
         return {"error": "The dataset does not exist. Please store the dataset first."}
-    data.to_csv("temp/data.csv", index=False)
-
-    # Load the data
-    analysis_code = f"{data_name} = pd.read_csv('temp/data.csv')\n" + analysis_code
-    analysis_code = "df = pd.read_csv('temp/data.csv')\n" + analysis_code
-    analysis_code = "data = pd.read_csv('temp/data.csv')\n" + analysis_code
-    # Add imports to the code
-    analysis_code = "import pandas as pd\nimport math\nimport numpy as np\n" + analysis_code
+
     # Add the results print
     analysis_code += "\nprint(result)"
-    analysis_code = "# -*- coding: utf-8 -*-\n" + analysis_code
-
-    with open("temp/analysis.py", "w", encoding="utf-8") as f:
-        f.write(analysis_code)
-    process = Popen(["python", "temp/analysis.py"], stdout=PIPE, stderr=PIPE)
-    while process.poll() is None:
-        sleep(0.1)
-    stdout, stderr = process.communicate()
-    if stderr:
-        return {"error": stderr.decode("utf-8")}
+
+    session = core.get_session_id()
+    with get_workspaces().call(session) as workdir:
+        output = get_pool().run(session, workdir, analysis_code, data_name, data, core.get_data_version(data_name),
+                                filename="temp/analysis.py")
+    print(f"\nAnalysis {output['exit_reason']} in {output['runtime']:.2f}s")
+    if output["peak_memory_mb"] is not None:
+        print(f"Peak memory {output['peak_memory_mb']:.0f}MB")
+    if output["stderr"]:
+        return {"error": output["stderr"]}
     else:
         print("\nResults:")
-        result = stdout.decode("latin-1").replace("'", '"')
+        result = output["stdout"].replace("'", '"')
         print(result)
         try:
             results = json.loads(result)
@@ -65,61 +56,68 @@ def analyze_data(analysis_code: str, data_name: str):
         return {"results": results}
 
 
+# The data can be loaded into a worker while the code is still being generated
+analyze_data.add_preparer("data_name", core.preload_data)
+analyze_data.uses_data = True
+
+
 @gpt_function
-def transform_data(transformation_code: str, data_name: str):
+def transform_data(data_name: str, transformation_code: str):
     """
     Useful for transforming data, e.g. sorting, pruning, dropping. The data is a pandas dataframe.
     Before calling this function ALWAYS call 'get_data_details' to understand the structure of the data.
+    :param data_name: the name of the data to be analyzed.
     :param transformation_code: the python code to be used to transform the data.
-    Load the data from "temp/data.csv". There are no json files.
-    Save the transformed dataframe to "temp/data.csv". Remember to save the data!
+    The data is already loaded as a pandas dataframe called "df", also available as "data" and under the data name.
+    pd, np and math are already imported. Do not read or write any files.
+    The dataframe assigned last is stored as the new version of the data, so end with an assignment of the whole
+    transformed dataframe, e.g. "df = df.dropna()". Do not assign anything else after it.
     This should be the code and just the code, do not add any additional comments or text.
     Make sure to only use columns that are specified in the data. Remember, they can be slightly different from the user input!
     Think about what columns are needed and not what exactly the user inputted.
     Always remember to deal correctly with missing values.
-    :param data_name: the name of the data to be analyzed.
     """
 
     transformation_code = re.sub(r"import.*\n", "", transformation_code)
-    transformation_code = re.sub(r"= pd.read_csv.*\n", "= pd.read_csv('temp/data.csv')", transformation_code)
-    transformation_code = re.sub(r"to_csv.*\n", "to_csv('temp/data.csv', index=False)", transformation_code)
-
-    transformation_code = f"{data_name} = pd.read_csv('temp/data.csv')\n" + transformation_code
-    transformation_code = f"df = pd.read_csv('temp/data.csv')\n" + transformation_code
-    transformation_code = f"data = pd.read_csv('temp/data.csv')\n" + transformation_code
-    # Add imports to the code
-    transformation_code = "import pandas as pd\nimport math\nimport numpy as np\n" + transformation_code
-    transformation_code = "# -*- coding: utf-8 -*-\n" + transformation_code
+    transformation_code = re.sub(r"pd\.read_\w+\([^)]*\)", "_data", transformation_code)
 
     # Find the last name to be assigned to checking which one appears last
-    final_data_name = ""
+    final_data_name = "data"
     for idx, line in enumerate(transformation_code.split("\n")):
         if "=" in line:
             name = line[:line.index("=")].strip()
-            if line.index(name) == 0:
-                final_data_name = line[:line.index("=")].strip()
+            if line.index(name) == 0 and name.isidentifier():
+                final_data_name = name
         if "to_csv" in line:
             final_data_name = line[:line.index(".")].strip()
-    transformation_code += f"\n{final_data_name}.to_csv('temp/data.csv', index=False)"
-
+    # The worker hands the final dataframe back directly, so the code does not need to save it
+    transformation_code = re.sub(r".*to_csv.*\n?", "", transformation_code)
 
-    os.makedirs("temp", exist_ok=True)
     data = core.get_data(data_name)
     if data is None:
         return {"error": "The dataset does not exist. Please store the dataset first."}
-    data.to_csv("temp/data.csv", index=False)
-
-    with open("temp/transformation.py", "w", encoding="utf-8") as f:
-        f.write(transformation_code)
-    process = Popen(["python", "temp/transformation.py"], stdout=PIPE, stderr=PIPE)
-    while process.poll() is None:
-        sleep(0.1)
-    stdout, stderr = process.communicate()
-    if stderr:
-        return {"error": stderr.decode("utf-8")}
-    transformed_data = pd.read_csv("temp/data.csv")
-    core.update_data(transformed_data, data_name)
-    return {"results": f"Data transformed successfully. There are now {len(transformed_data)} rows."}
+
+    session = core.get_session_id()
+    with get_workspaces().call(session) as workdir:
+        output = get_pool().run(session, workdir, transformation_code, data_name, data,
+                                core.get_data_version(data_name), result_name=final_data_name,
+                                filename="temp/transformation.py")
+    print(f"\nTransformation {output['exit_reason']} in {output['runtime']:.2f}s")
+    if output["peak_memory_mb"] is not None:
+        print(f"Peak memory {output['peak_memory_mb']:.0f}MB")
+    if output["stderr"]:
+        return {"error": output["stderr"]}
+    transformed_data = output["result"]
+    report = core.update_data(transformed_data, data_name, code=transformation_code, result_name=final_data_name)
+    result = {"results": f"Data transformed successfully. There are now {len(transformed_data)} rows."}
+    if report is not None:
+        result["memory_saved_mb"] = report["saved_mb"]
+    return result
+
+
+transform_data.add_preparer("data_name", core.preload_data)
+transform_data.uses_data = True
+
 
 @gpt_function
 def undo_transformation(data_name: str):
@@ -127,10 +125,16 @@ def undo_transformation(data_name: str):
     Undoes the last transformation. This is useful if you want to undo a transformation.
     :param data_name: the name of the data to be undone.
     """
-    result = core.undo_data(data_name)
+    try:
+        result = core.undo_data(data_name)
+    except RuntimeError as e:
+        return {"error": str(e)}
     if result is None:
         return {"error": "This data name does not exist. Please check the data name."}
     if not result:
         return {"error": "There are no more transformations to undo."}
     new_data = core.get_data(data_name)
     return {"results": f"Transformation undone successfully. There are now {len(new_data)} rows."}
+
+
+undo_transformation.uses_data = True
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+# Columns with more rows than this get an estimated distinct count instead of an exact one
+_EXACT_DISTINCT_ROWS = 100_000
+# The number of smallest hashes used by the distinct count estimate
+_KMV_SIZE = 1024
+_QUANTILES = [0.25, 0.5, 0.75]
+
+
+def _jsonable(value):
+    """
+    Converts a pandas or numpy scalar to a value that can be dumped to json.
+    :param value: the value to convert
+    :return: the converted value
+    """
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, (int, bool, str)):
+        return value
+    return str(value)
+
+
+def _distinct_count(column: pd.Series) -> int:
+    """
+    Counts the distinct values of a column.
+    Large columns are estimated from the smallest hashes of their values (k minimum values),
+    which only needs a single vectorized pass over the column.
+    :param column: the column without missing values
+    :return: the number of distinct values
+    """
+    if len(column) <= _EXACT_DISTINCT_ROWS:
+        return int(column.nunique())
+    hashes = pd.util.hash_pandas_object(column, index=False).to_numpy()
+    # Only hashes below the cutoff can be among the smallest ones, when most values are distinct
+    fraction = min(1.0, 4 * _KMV_SIZE / len(hashes))
+    smallest = np.unique(hashes[hashes <= np.uint64(fraction * np.iinfo(np.uint64).max)])
+    if len(smallest) < _KMV_SIZE:
+        return int(column.nunique())
+    kth = float(smallest[_KMV_SIZE - 1]) / float(np.iinfo(np.uint64).max)
+    return int((_KMV_SIZE - 1) / kth)
+
+
+def _profile_column(column: pd.Series, top_n: int) -> dict:
+    """
+    Profiles the values of a single column, apart from its numeric statistics.
+    :param column: the column
+    :param top_n: the number of most common values to include
+    :return: the profile of the column
+    """
+    values = column.dropna()
+    try:
+        distinct = _distinct_count(values)
+    except TypeError:
+        # Unhashable values, e.g. lists from json, are profiled by their text
+        values = values.astype(str)
+        distinct = _distinct_count(values)
+
+    profile = {"distinct": distinct}
+    if pd.api.types.is_datetime64_any_dtype(column):
+        profile["min"] = _jsonable(values.min()) if len(values) else None
+        profile["max"] = _jsonable(values.max()) if len(values) else None
+    elif not pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column):
+        top = values.value_counts().head(top_n)
+        profile["top_values"] = {str(value): int(count) for value, count in top.items()}
+    return profile
+
+
+def profile_dataframe(data: pd.DataFrame, top_n: int = 3) -> dict:
+    """
+    Computes a profile of every column of a dataframe.
+    The dtype, fraction of missing values, an estimate of the number of distinct values,
+    the most common values of non-numeric columns and the range and quantiles of numeric columns.
+    Statistics that apply to many columns at once are computed on the whole frame in one pass.
+    :param data: the dataframe to profile
+    :param top_n: the number of most common values to include for non-numeric columns
+    :return: the number of rows and a profile per column
+    """
+    null_fractions = data.isna().mean() if len(data) else pd.Series(0.0, index=data.columns)
+    numeric = data.select_dtypes(include="number").select_dtypes(exclude="bool")
+    numeric_stats = None
+    if len(numeric.columns) and len(data):
+        numeric_stats = numeric.quantile([0.0] + _QUANTILES + [1.0])
+
+    columns = {}
+    for name in data.columns:
+        column = data[name]
+        profile = {
+            "dtype": str(column.dtype),
+            "null_fraction": _jsonable(null_fractions[name]),
+        }
+        profile.update(_profile_column(column, top_n))
+        if numeric_stats is not None and name in numeric_stats.columns:
+            stats = numeric_stats[name]
+            profile["min"] = _jsonable(stats[0.0])
+            profile["max"] = _jsonable(stats[1.0])
+            profile["quantiles"] = {str(q): _jsonable(stats[q]) for q in _QUANTILES}
+        columns[str(name)] = profile
+
+    return {"rows": len(data), "columns": columns}
@@ -0,0 +1,59 @@
+from src.gpt_function import gpt_function
+import data.core as core
+import streamlit as st
+import duckdb
+import json
+import re
+
+
+@gpt_function
+def query_data(query: str, max_rows: int = 50, save_as: str = ""):
+    """
+    Useful for filtering, sorting, grouping, aggregating and joining stored data using SQL.
+    This is much faster than 'analyze_data', so prefer it whenever the question can be answered with SQL.
+    Every stored dataset is available as a table with the same name as the data. Quote names with double quotes.
+    Before calling this function ALWAYS call 'get_data_details' to understand the structure of the data.
+    :param query: a single DuckDB SQL query, e.g. SELECT city, avg(price) FROM "sales" GROUP BY city
+    :param max_rows: the maximum number of rows of the result to return, optional integer
+    :param save_as: a name to store the full result under as new data, optional. Leave empty to not store the result.
+    """
+
+    query = query.strip().rstrip(";")
+    # Files, extensions and the network are off limits, the query can only read the registered data
+    connection = duckdb.connect(config={"enable_external_access": False})
+    try:
+        # Only the data referenced in the query is registered, so spilled data is not loaded needlessly
+        for name in st.session_state["data"]:
+            if re.search(re.escape(name), query, re.IGNORECASE):
+                connection.register(name, core.get_data(name))
+
+        relation = connection.sql(query)
+        if relation is None:
+            return {"error": "The query did not return a result. Only SELECT queries are supported."}
+        if save_as:
+            result = relation.df()
+            preview = result.head(max_rows)
+        else:
+            preview = relation.limit(max_rows + 1).df()
+            result = None
+    except duckdb.Error as e:
+        return {"error": f"The query failed: {e}"}
+    finally:
+        connection.close()
+
+    output = {
+        "columns": list(preview.columns),
+        "rows": json.loads(preview.head(max_rows).to_json(orient="records", date_format="iso")),
+    }
+    if result is None:
+        output["truncated"] = len(preview) > max_rows
+    else:
+        output["truncated"] = len(result) > max_rows
+        output["total_rows"] = len(result)
+        core.save_new_data(result, save_as, f"Result of the query: {query}")
+        output["saved_as"] = save_as
+    return output
+
+
+# The query can read any dataset and save a new one, so it runs one at a time with the other calls on the data
+query_data.uses_data = True
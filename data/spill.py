@@ -0,0 +1,139 @@
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import pandas as pd
+import yaml
+from data.workers import write_frame, read_frame
+
+
+class SpillStore:
+    """
+    A process-wide store for the data of every dataset version of every session.
+    Keeps the most recently used data in memory within a memory budget,
+    and spills the least recently used data to columnar files on local disk.
+    Spilled data is loaded back lazily, memory-mapped where possible, when it is next accessed.
+    """
+
+    def __init__(self, budget_mb: float = 4096, spill_dir: str = None):
+        self.budget_mb = budget_mb
+        # Each process spills to its own directory, which is removed when the process exits
+        root = spill_dir or os.path.join(tempfile.gettempdir(), "datagpt-spill")
+        self.spill_dir = os.path.join(root, str(os.getpid()))
+        os.makedirs(self.spill_dir, exist_ok=True)
+        atexit.register(shutil.rmtree, self.spill_dir, ignore_errors=True)
+        # version -> {"data": dataframe or None, "size_mb": float, "path": spill file or None}
+        self.entries = {}
+        # The versions that are in memory, least recently used first
+        self.resident = OrderedDict()
+        self.resident_mb = 0.0
+        self.lock = threading.RLock()
+
+    def put(self, version: str, data: pd.DataFrame, size_mb: float):
+        """
+        Adds the data of a version to the store.
+        :param version: the id of the version
+        :param data: the data of the version
+        :param size_mb: the memory used by the data in MB
+        """
+        with self.lock:
+            self.discard(version)
+            self.entries[version] = {"data": data, "size_mb": size_mb, "path": None}
+            self._make_resident(version)
+
+    def has(self, version: str) -> bool:
+        """
+        Checks if the store has the data of a version, in memory or on disk.
+        :param version: the id of the version
+        :return: True if the data is in the store
+        """
+        return version in self.entries
+
+    def get(self, version: str) -> pd.DataFrame | None:
+        """
+        Gets the data of a version, loading it back from disk if it was spilled.
+        :param version: the id of the version
+        :return: the data, or None if the store does not have it
+        """
+        with self.lock:
+            entry = self.entries.get(version)
+            if entry is None:
+                return None
+            if entry["data"] is None:
+                entry["data"] = read_frame(entry["path"])
+            self._make_resident(version)
+            return entry["data"]
+
+    def discard(self, version: str):
+        """
+        Removes the data of a version from memory and from disk.
+        :param version: the id of the version
+        """
+        with self.lock:
+            entry = self.entries.pop(version, None)
+            if entry is None:
+                return
+            if version in self.resident:
+                del self.resident[version]
+                self.resident_mb -= entry["size_mb"]
+            if entry["path"] is not None and os.path.exists(entry["path"]):
+                os.remove(entry["path"])
+
+    def discard_all(self, versions: list[str]):
+        """
+        Removes the data of several versions from memory and from disk.
+        :param versions: the ids of the versions
+        """
+        for version in list(versions):
+            self.discard(version)
+
+    def _make_resident(self, version: str):
+        """
+        Marks the data of a version as in memory and most recently used, then enforces the budget.
+        :param version: the id of the version
+        """
+        if version in self.resident:
+            self.resident.move_to_end(version)
+        else:
+            self.resident[version] = True
+            self.resident_mb += self.entries[version]["size_mb"]
+        self._enforce_budget(keep=version)
+
+    def _enforce_budget(self, keep: str):
+        """
+        Spills the least recently used data to disk until the data in memory fits in the budget.
+        :param keep: a version that must stay in memory, because it is being used
+        """
+        while self.resident_mb > self.budget_mb:
+            version = next((v for v in self.resident if v != keep), None)
+            if version is None:
+                break
+            entry = self.entries[version]
+            # Versions never change, so a file written by an earlier spill can be reused
+            if entry["path"] is None:
+                entry["path"] = write_frame(entry["data"], os.path.join(self.spill_dir, version))
+            entry["data"] = None
+            del self.resident[version]
+            self.resident_mb -= entry["size_mb"]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SpillStore:
+    """
+    Get the process-wide data store, creating it on first use.
+    :return: the data store
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["data"]
+            _store = SpillStore(
+                budget_mb=config["memory_budget_mb"],
+                spill_dir=config["spill_dir"],
+            )
+    return _store
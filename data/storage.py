@@ -20,14 +20,20 @@ def manual_write_data(data: str, name: str, summary: str):
         return {"error": "The data could not be parsed into a pandas dataframe. You must reformat the data and try again."}
     print("\nStoring data...")
     print(data)
-    core.save_new_data(data, name, summary)
+    report = core.save_new_data(data, name, summary)
 
-    return {"result": "The data has been stored. No additional output is required."}
+    result = {"result": "The data has been stored. No additional output is required."}
+    if report is not None:
+        result["memory_mb"] = report["after_mb"]
+        result["memory_saved_mb"] = report["saved_mb"]
+    return result
 
 @gpt_function
 def get_data_details(name: str):
     """
-    Useful for getting the details of data. The name, summary, columns, and sample of the dataframe will be returned.
+    Useful for getting the details of data. The name, summary, columns, sample and a profile of every column
+    (dtype, fraction of missing values, number of distinct values, most common values, range and quantiles) will be returned.
+    The profile often answers questions about the structure of the data without having to analyze it.
 
     :param name: the name of the dataset.
     """
@@ -39,10 +45,13 @@ def get_data_details(name: str):
         summary = data["summary"]
         columns = data["columns"]
         sample = data["data"].head(1).to_json()
+        profile = core.get_data_profile(name)
         return {
             "name": name,
             "summary": summary,
             "columns": columns,
+            "rows": profile["rows"],
+            "profile": profile["columns"],
             "sample": sample
         }
 
@@ -59,4 +68,10 @@ def read_data(name: str):
     if data is None:
         return {"error": "The dataset does not exist. Please store the dataset first."}
     else:
-        return {"data": data.to_json()}
\ No newline at end of file
+        return {"data": data.to_json()}
+
+
+# Calls on the data store run one at a time, in the order they were made
+manual_write_data.uses_data = True
+get_data_details.uses_data = True
+read_data.uses_data = True
@@ -0,0 +1,580 @@
+import io
+import os
+import sys
+import warnings
+import time
+import threading
+import traceback
+import contextlib
+import multiprocessing as mp
+import yaml
+
+
+def _rss_mb() -> float:
+    """
+    Get the current resident memory of this process.
+    :return: the resident set size in MB
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _process_rss_mb(pid: int) -> float | None:
+    """
+    Get the current resident memory of another process.
+    Only supported on Linux.
+    :param pid: the id of the process
+    :return: the resident set size in MB, or None if it cannot be read
+    """
+    try:
+        with open(f"/proc/{pid}/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_memory_mb() -> float:
+    """
+    Get the peak resident memory of this process since it was last reset.
+    :return: the peak resident set size in MB
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _reset_peak_memory():
+    """
+    Resets the peak resident memory of this process, so that it can be measured per job.
+    Only supported on Linux, elsewhere the peak stays the peak of the whole process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class _CappedOutput(io.StringIO):
+    """
+    A text buffer that stops storing output once it reaches a size limit.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.truncated = False
+
+    def write(self, text: str) -> int:
+        remaining = self.limit - self.tell()
+        if len(text) > remaining:
+            self.truncated = True
+            if remaining > 0:
+                super().write(text[:remaining])
+            return len(text)
+        return super().write(text)
+
+    def getvalue(self) -> str:
+        value = super().getvalue()
+        if self.truncated:
+            value += "\n... output truncated"
+        return value
+
+
+class _MemoryLimitExceeded(Exception):
+    """
+    Raised in the pool when a worker goes over its resident memory limit.
+    """
+
+
+class _CPULimitExceeded(Exception):
+    """
+    Raised in a worker when a job uses up its CPU time.
+    """
+
+
+def _on_cpu_limit(signum, frame):
+    raise _CPULimitExceeded("The code used more CPU time than it is allowed and was stopped.")
+
+
+def write_frame(data, path: str, handoff: str = "arrow") -> str:
+    """
+    Writes a dataframe to a file that can be passed between processes.
+    Arrow IPC files keep the dtypes and can be memory-mapped by the reader.
+    Frames that arrow cannot represent, e.g. mixed object columns, fall back to a pickle.
+    :param data: the dataframe to write
+    :param path: the path of the file without an extension
+    :param handoff: the format to use, either "arrow" or "csv"
+    :return: the path of the written file
+    """
+    if handoff == "csv":
+        data.to_csv(path + ".csv", index=False)
+        return path + ".csv"
+
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    try:
+        feather.write_feather(data, path + ".arrow", compression="uncompressed")
+        return path + ".arrow"
+    except (pa.ArrowException, TypeError, ValueError):
+        data.to_pickle(path + ".pkl")
+        return path + ".pkl"
+
+
+def read_frame(path: str):
+    """
+    Reads a dataframe written by 'write_frame'.
+    :param path: the path of the file
+    :return: the dataframe
+    """
+    import pandas as pd
+    if path.endswith(".arrow"):
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True).to_pandas()
+    if path.endswith(".pkl"):
+        return pd.read_pickle(path)
+    return pd.read_csv(path)
+
+
+def _snapshot_state() -> dict:
+    """
+    Takes a snapshot of the process-wide state that generated code may change.
+    :return: the snapshot, to be restored with '_restore_state'
+    """
+    return {
+        "cwd": os.getcwd(),
+        "modules": set(sys.modules),
+        "path": list(sys.path),
+        "environ": dict(os.environ),
+    }
+
+
+def _restore_state(state: dict):
+    """
+    Restores the process-wide state of a worker after a job, so that the next job, possibly of
+    another session, does not see what this one changed.
+    Resets the options of pandas, numpy and matplotlib, the working directory, the environment,
+    the import path, and removes any packages the job imported.
+    Submodules of packages that were already loaded are kept, the loaded packages may hold on to them.
+    Changes made to the imported libraries themselves, e.g. patched functions, cannot be undone,
+    the pool recycles workers between sessions for that.
+    :param state: the snapshot taken by '_snapshot_state'
+    """
+    import numpy as np
+    import pandas as pd
+    import matplotlib
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        pd.reset_option("all")
+    np.seterr(all="warn", under="ignore")
+    np.set_printoptions()
+    matplotlib.rcdefaults()
+    os.chdir(state["cwd"])
+    if os.environ != state["environ"]:
+        os.environ.clear()
+        os.environ.update(state["environ"])
+    sys.path[:] = state["path"]
+    packages = {name.partition(".")[0] for name in state["modules"]}
+    for name in list(sys.modules):
+        if name.partition(".")[0] not in packages:
+            del sys.modules[name]
+
+
+def _worker_main(conn, limits: dict):
+    """
+    The main loop of a worker process.
+    Imports all the heavy libraries once and then executes jobs sent through the pipe.
+    Keeps the last loaded dataset in memory so that repeated calls on the same data skip loading it.
+    The CPU time of each job is limited, and so is the address space of the worker if configured.
+    The global state the code may change is restored after every job.
+    :param conn: the worker end of the pipe to the pool
+    :param limits: the memory, CPU and output limits of the worker
+    """
+    import math
+    import numpy as np
+    import pandas as pd
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import pyarrow.feather
+    try:
+        import resource
+        import signal
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        if limits["max_address_space_mb"] is not None:
+            _, memory_hard = resource.getrlimit(resource.RLIMIT_AS)
+            memory_soft = limits["max_address_space_mb"] * 1024 * 1024
+            if memory_hard != resource.RLIM_INFINITY:
+                memory_soft = min(memory_soft, memory_hard)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_soft, memory_hard))
+        _, cpu_hard = resource.getrlimit(resource.RLIMIT_CPU)
+        signal.signal(signal.SIGXCPU, _on_cpu_limit)
+
+    loaded = {"key": None, "data": None}
+    state = _snapshot_state()
+    conn.send({"ready": True})
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        stdout = _CappedOutput(limits["max_output_kb"] * 1024)
+        stderr = _CappedOutput(limits["max_output_kb"] * 1024)
+        result_path = None
+        exit_reason = "ok"
+        _reset_peak_memory()
+        if resource is not None:
+            # The CPU limit is for the whole process, so move it to just past what this job may use
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            cpu_soft = int(usage.ru_utime + usage.ru_stime) + limits["cpu_seconds"] + 1
+            if cpu_hard != resource.RLIM_INFINITY:
+                cpu_soft = min(cpu_soft, cpu_hard)
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_soft, cpu_hard))
+        try:
+            os.chdir(job["cwd"])
+            if loaded["key"] != job["data_key"]:
+                loaded["key"] = None
+                loaded["data"] = None
+                loaded["data"] = read_frame(job["data_path"])
+                loaded["key"] = job["data_key"]
+
+            # The data is loaded once and bound to all the names the code may use
+            data = loaded["data"].copy()
+            namespace = {
+                "math": math, "np": np, "pd": pd, "plt": plt, "sns": sns,
+                "_data": data, "data": data, "df": data, job["data_name"]: data,
+            }
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                exec(compile(job["code"], job["filename"], "exec"), namespace)
+
+            if job["result_name"] is not None:
+                result = namespace.get(job["result_name"])
+                if not isinstance(result, pd.DataFrame):
+                    raise TypeError(f"'{job['result_name']}' is not a dataframe, the transformation must produce one.")
+                result_path = write_frame(result, job["result_path"], job["handoff"])
+        except BaseException as e:
+            if isinstance(e, MemoryError):
+                exit_reason = "memory_limit"
+            elif isinstance(e, _CPULimitExceeded):
+                exit_reason = "cpu_limit"
+            else:
+                exit_reason = "error"
+            # Skip the frame of this loop, only the generated code is relevant
+            stderr.write("".join(traceback.format_exception(type(e), e, e.__traceback__.tb_next)))
+        finally:
+            if resource is not None:
+                resource.setrlimit(resource.RLIMIT_CPU, (cpu_hard, cpu_hard))
+            plt.close("all")
+            _restore_state(state)
+
+        conn.send({
+            "stdout": stdout.getvalue(),
+            "stderr": stderr.getvalue(),
+            "result_path": result_path,
+            "data_key": loaded["key"],
+            "exit_reason": exit_reason,
+            "truncated": stdout.truncated or stderr.truncated,
+            "peak_memory_mb": _peak_memory_mb(),
+            "rss_mb": _rss_mb(),
+        })
+
+
+class _Worker:
+    """
+    A handle on a single pre-warmed worker process.
+    """
+
+    def __init__(self, context, limits: dict):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, limits), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.jobs = 0
+        self.rss_mb = 0.0
+        self.session = None
+        self.data_key = None
+        self.busy = False
+
+    def wait_ready(self):
+        """
+        Blocks until the worker has finished importing its libraries.
+        """
+        if not self.ready:
+            self.conn.recv()
+            self.ready = True
+
+    def run(self, job: dict, timeout: float, max_memory_mb: int = None, interval: float = 0.1) -> dict:
+        """
+        Sends a job to the worker and waits for the result.
+        Waits on the pipe becoming readable, so the result is picked up as soon as it is sent,
+        and checks the resident memory of the worker in between.
+        :param job: the job to run
+        :param timeout: the maximum number of seconds to wait for the result
+        :param max_memory_mb: the maximum resident memory of the worker in MB, None for no limit
+        :param interval: the number of seconds between memory checks
+        :return: the result of the job
+        """
+        self.wait_ready()
+        start = time.perf_counter()
+        self.conn.send(job)
+        while not self.conn.poll(min(interval, max(0.0, start + timeout - time.perf_counter()))):
+            if time.perf_counter() - start >= timeout:
+                raise TimeoutError()
+            if max_memory_mb is not None:
+                rss_mb = _process_rss_mb(self.process.pid)
+                if rss_mb is not None and rss_mb > max_memory_mb:
+                    # Killed straight away, the worker may not get to read a stop message before using more
+                    self.process.kill()
+                    raise _MemoryLimitExceeded()
+        result = self.conn.recv()
+        result["runtime"] = time.perf_counter() - start
+        self.jobs += 1
+        self.rss_mb = result["rss_mb"]
+        self.data_key = result["data_key"]
+        return result
+
+    def stop(self):
+        """
+        Stops the worker process.
+        """
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    A pool of long-lived worker processes used to run generated data code.
+    Workers have pandas, numpy, matplotlib and seaborn already imported.
+    Each session is pinned to a worker where possible, so that the worker can keep the session's data loaded.
+    Workers are recycled after a number of jobs or once they use too much memory.
+    Workers restore their global state after every job, but code can still change the imported libraries,
+    so by default a worker is also recycled before it runs a job for a different session.
+    Jobs are supervised: they are killed after a wall-clock timeout, and limited in memory, CPU time and output.
+    The memory limit is on resident memory, checked by the pool while a job runs. A limit on the address space
+    can be set as well, but it also counts memory that is only reserved, like memory-mapped arrow files
+    and the arenas of the math libraries, so it can fail code that would fit in memory.
+    The workers are not sandboxed, they run with the same filesystem and network access as the app.
+    """
+
+    def __init__(self, size: int = 2, max_jobs: int = 50, max_rss_mb: int = 1024, handoff: str = "arrow",
+                 timeout_seconds: int = 120, cpu_seconds: int = 120, max_memory_mb: int = 4096,
+                 max_address_space_mb: int = None, max_output_kb: int = 64, isolate_sessions: bool = True):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self.handoff = handoff
+        self.timeout = timeout_seconds
+        self.max_memory_mb = max_memory_mb
+        self.isolate_sessions = isolate_sessions
+        self.limits = {
+            "cpu_seconds": cpu_seconds,
+            "max_address_space_mb": max_address_space_mb,
+            "max_output_kb": max_output_kb,
+        }
+        # Spawn rather than fork, forking the threaded streamlit server is not safe
+        self.context = mp.get_context("spawn")
+        self.condition = threading.Condition()
+        self.workers = [_Worker(self.context, self.limits) for _ in range(size)]
+
+    def _acquire(self, session: str) -> _Worker:
+        """
+        Gets a free worker, preferring the one the session used last.
+        Blocks until a worker is free.
+        If sessions are isolated, a worker last used by another session is replaced with a fresh one.
+        :param session: the id of the session running the job
+        :return: the worker to use
+        """
+        with self.condition:
+            while True:
+                free = [worker for worker in self.workers if not worker.busy]
+                if free:
+                    pinned = [worker for worker in free if worker.session == session]
+                    unpinned = [worker for worker in free if worker.session is None]
+                    worker = (pinned or unpinned or free)[0]
+                    worker.busy = True
+                    if worker.session in (None, session) or not self.isolate_sessions:
+                        worker.session = session
+                        return worker
+                    break
+                self.condition.wait()
+
+        worker.stop()
+        replacement = _Worker(self.context, self.limits)
+        replacement.busy = True
+        replacement.session = session
+        with self.condition:
+            # If the pool was shut down in the meantime, the replacement is stopped once it is released
+            if worker in self.workers:
+                self.workers[self.workers.index(worker)] = replacement
+        return replacement
+
+    def _release(self, worker: _Worker, failed: bool = False):
+        """
+        Returns a worker to the pool, replacing it if it needs recycling.
+        :param worker: the worker to return
+        :param failed: whether the worker failed and must be replaced
+        """
+        with self.condition:
+            # The pool was shut down while the job was running
+            if worker not in self.workers:
+                worker.stop()
+                return
+        if failed or worker.jobs >= self.max_jobs or worker.rss_mb >= self.max_rss_mb:
+            worker.stop()
+            replacement = _Worker(self.context, self.limits)
+            with self.condition:
+                if worker not in self.workers:
+                    replacement.stop()
+                    return
+                self.workers[self.workers.index(worker)] = replacement
+                self.condition.notify()
+            return
+        with self.condition:
+            worker.busy = False
+            self.condition.notify()
+
+    def run(self, session: str, workdir: str, code: str, data_name: str, data, data_key: str,
+            result_name: str = None, filename: str = "<generated>") -> dict:
+        """
+        Runs code on a worker with the data bound to 'data', 'df' and the name of the data.
+        The data is only written out for the worker if it does not have this version loaded already.
+        :param session: the id of the session running the code
+        :param workdir: the workspace of the call, the code is run from here
+        :param code: the python code to run
+        :param data_name: the name of the data
+        :param data: the dataframe to run the code on
+        :param data_key: a key identifying the version of the data, used to skip reloading it
+        :param result_name: the name of a dataframe to return from the code, if any
+        :param filename: the name of the code shown in tracebacks
+        :return: a dictionary with the stdout and stderr of the code, the returned dataframe if requested,
+        the runtime in seconds, the peak memory in MB and the reason the code exited
+        """
+        scratch = os.path.join(workdir, "temp")
+        job = {
+            "code": code,
+            "cwd": workdir,
+            "data_name": data_name,
+            "data_key": data_key,
+            "data_path": None,
+            "result_name": result_name,
+            "result_path": os.path.join(scratch, "result"),
+            "handoff": self.handoff,
+            "filename": filename,
+        }
+        worker = self._acquire(session)
+        start = time.perf_counter()
+        try:
+            if worker.data_key != data_key:
+                os.makedirs(scratch, exist_ok=True)
+                job["data_path"] = write_frame(data, os.path.join(scratch, "data"), self.handoff)
+            result = worker.run(job, self.timeout, self.max_memory_mb)
+        except _MemoryLimitExceeded:
+            self._release(worker, failed=True)
+            return self._failure("memory_limit", f"The code used more than {self.max_memory_mb}MB of memory "
+                                                 f"and was stopped.", start)
+        except TimeoutError:
+            self._release(worker, failed=True)
+            return self._failure("timeout", f"The code took longer than {self.timeout} seconds and was stopped.", start)
+        except (EOFError, OSError):
+            self._release(worker, failed=True)
+            return self._failure("crashed", "The worker running the code crashed.", start)
+        # A worker that hit a limit may be left in a bad state, so it is replaced
+        self._release(worker, failed=result["exit_reason"] in ("memory_limit", "cpu_limit"))
+
+        output = {
+            "stdout": result["stdout"],
+            "stderr": result["stderr"],
+            "result": None,
+            "exit_reason": result["exit_reason"],
+            "truncated": result["truncated"],
+            "runtime": result["runtime"],
+            "peak_memory_mb": result["peak_memory_mb"],
+        }
+        if result["result_path"] is not None:
+            output["result"] = read_frame(result["result_path"])
+            os.remove(result["result_path"])
+        return output
+
+    @staticmethod
+    def _failure(exit_reason: str, message: str, start: float) -> dict:
+        """
+        Builds the output of a job that did not finish.
+        :param exit_reason: the reason the job did not finish
+        :param message: the error message for the job
+        :param start: the time the job was started at
+        :return: the output of the job
+        """
+        return {
+            "stdout": "",
+            "stderr": message,
+            "result": None,
+            "exit_reason": exit_reason,
+            "truncated": False,
+            "runtime": time.perf_counter() - start,
+            "peak_memory_mb": None,
+        }
+
+    def shutdown(self):
+        """
+        Stops all the workers.
+        """
+        with self.condition:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> WorkerPool:
+    """
+    Get the process-wide worker pool, creating it on first use.
+    :return: the worker pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["workers"]
+            _pool = WorkerPool(
+                size=config["pool_size"],
+                max_jobs=config["max_jobs"],
+                max_rss_mb=config["max_rss_mb"],
+                handoff=config["handoff"],
+                timeout_seconds=config["timeout_seconds"],
+                cpu_seconds=config["cpu_seconds"],
+                max_memory_mb=config["max_memory_mb"],
+                max_address_space_mb=config.get("max_address_space_mb"),
+                max_output_kb=config["max_output_kb"],
+                isolate_sessions=config.get("isolate_sessions", True),
+            )
+    return _pool
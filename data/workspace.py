@@ -0,0 +1,110 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import contextlib
+import yaml
+
+
+def _default_root() -> str:
+    """
+    Get the default directory to keep workspaces in.
+    Prefers tmpfs so that scratch files never touch the disk.
+    :return: the path of the directory
+    """
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return os.path.join("/dev/shm", "datagpt")
+    return os.path.join(tempfile.gettempdir(), "datagpt")
+
+
+class WorkspaceManager:
+    """
+    Creates, tracks and removes isolated scratch directories for running generated code.
+    Each session gets its own directory, and each call gets a fresh directory inside it,
+    so that concurrent sessions and calls never overwrite each other's files.
+    """
+
+    def __init__(self, root: str = None, ttl_minutes: int = 60, collect_interval_minutes: int = 5):
+        self.root = root or _default_root()
+        self.ttl = ttl_minutes * 60
+        self.collect_interval = collect_interval_minutes * 60
+        self.last_used = {}
+        self.last_collect = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def session_dir(self, session: str) -> str:
+        """
+        Get the workspace of a session, creating it if needed.
+        :param session: the id of the session
+        :return: the path of the session workspace
+        """
+        path = os.path.join(self.root, session)
+        os.makedirs(path, exist_ok=True)
+        with self.lock:
+            self.last_used[session] = time.time()
+        return path
+
+    @contextlib.contextmanager
+    def call(self, session: str):
+        """
+        Creates a workspace for a single call inside the session workspace and removes it afterwards.
+        The workspace has a 'temp' directory, so generated code can keep using relative 'temp/...' paths.
+        :param session: the id of the session
+        :return: the path of the call workspace
+        """
+        self.collect()
+        path = os.path.join(self.session_dir(session), uuid.uuid4().hex)
+        os.makedirs(os.path.join(path, "temp"))
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def collect(self, force: bool = False):
+        """
+        Removes the workspaces of sessions that have not been used for longer than the ttl.
+        Also removes workspaces left behind by previous runs of the app.
+        :param force: whether to collect even if the last collection was recent
+        """
+        now = time.time()
+        with self.lock:
+            if not force and now - self.last_collect < self.collect_interval:
+                return
+            self.last_collect = now
+
+        for session in os.listdir(self.root):
+            path = os.path.join(self.root, session)
+            with self.lock:
+                last_used = self.last_used.get(session)
+                if last_used is None:
+                    try:
+                        last_used = os.path.getmtime(path)
+                    except OSError:
+                        continue
+                if now - last_used < self.ttl:
+                    continue
+                self.last_used.pop(session, None)
+            shutil.rmtree(path, ignore_errors=True)
+
+
+_workspaces = None
+_workspaces_lock = threading.Lock()
+
+
+def get_workspaces() -> WorkspaceManager:
+    """
+    Get the process-wide workspace manager, creating it on first use.
+    :return: the workspace manager
+    """
+    global _workspaces
+    with _workspaces_lock:
+        if _workspaces is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["workspace"]
+            _workspaces = WorkspaceManager(
+                root=config["root"],
+                ttl_minutes=config["ttl_minutes"],
+            )
+    return _workspaces
@@ -1,5 +1,5 @@
 from bs4 import BeautifulSoup as bsoup
-import requests
+from src.http_client import get_http_client
 from src.gpt_function import gpt_function
 from agents.basic import html_extract
 
@@ -13,7 +13,7 @@ def get_cik(company: str):
 
     params = {"company": company}
     url = "https://www.sec.gov/cgi-bin/cik_lookup"
-    req = requests.get(url, params=params)
+    req = get_http_client().get(url, params=params)
     if req.status_code != 200:
         return {"result": f"HTTP REQUEST ERROR!: {req.status_code}"}
     else:
@@ -44,7 +44,7 @@ def get_company_info(cik: str):
     :param cik: the CIK of a company. Do not invent, use get_cik to get the CIK of a company.
     """
 
-    response = requests.get(f"https://data.sec.gov/submissions/CIK{cik}.json", headers={"User-Agent": "test test"})
+    response = get_http_client().get(f"https://data.sec.gov/submissions/CIK{cik}.json", headers={"User-Agent": "test test"})
     if response.status_code != 200:
         return {"result": f"HTTP REQUEST ERROR!: {response.status_code}"}
     else:
@@ -68,7 +68,7 @@ def get_company_filings(cik: str, max_results: int = 20):
     :param max_results: the maximum number of results to return, optional integer
     """
 
-    response = requests.get(f"https://data.sec.gov/submissions/CIK{cik}.json", headers={"User-Agent": "test test"})
+    response = get_http_client().get(f"https://data.sec.gov/submissions/CIK{cik}.json", headers={"User-Agent": "test test"})
     if response.status_code != 200:
         return {"result": f"HTTP REQUEST ERROR!: {response.status_code}"}
     else:
@@ -93,7 +93,7 @@ def get_full_filing(cik: str, accession_number: str):
     :param accession_number: the accession number of the filing
     """
 
-    response = requests.get(f"https://data.sec.gov/submissions/CIK{cik}.json", headers={"User-Agent": "test test"})
+    response = get_http_client().get(f"https://data.sec.gov/submissions/CIK{cik}.json", headers={"User-Agent": "test test"})
     if response.status_code != 200:
         return {"result": f"HTTP REQUEST ERROR!: {response.status_code}"}
     else:
@@ -106,7 +106,7 @@ def get_full_filing(cik: str, accession_number: str):
 
     url = f"https://www.sec.gov/Archives/edgar/data/{cik.replace('000', '')}/{accession_number.replace('-', '')}/{primaryDocument}"
     print(url)
-    response = requests.get(url, headers={"User-Agent": "test test"})
+    response = get_http_client().get(url, headers={"User-Agent": "test test"})
     if response.status_code != 200:
         return {"result": f"HTTP REQUEST ERROR!: {response.status_code}"}
     else:
@@ -1,5 +1,5 @@
 from secret import keys
-import requests
+from src.http_client import get_http_client
 import streamlit as st
 from src.gpt_function import gpt_function
 import json
@@ -40,7 +40,7 @@ def search_nearby(keyword: str,
     raw_location = st.session_state.raw_geo["coords"]
     latlong = f"{round(raw_location['latitude'], 6)},{round(raw_location['longitude'], 6)}"
     url = f"https://maps.googleapis.com/maps/api/place/nearbysearch/json?location={latlong}&radius={radius}&type={category}&keyword={keyword}&key={keys.gmaps_key}&opennow={opennow}&minprice={minprice}&maxprice={maxprice}"
-    response = requests.get(url)
+    response = get_http_client().get(url)
     results = json.loads(response.text)["results"]
 
     filtered = {"results": []}
@@ -93,7 +93,7 @@ def lookup_physical_place(query: str,
     else:
         url = f"https://maps.googleapis.com/maps/api/place/textsearch/json?query={query}&location={location}&key={keys.gmaps_key}&opennow={opennow}&minprice={minprice}&maxprice={maxprice}"
 
-    response = requests.get(url)
+    response = get_http_client().get(url)
 
     filtered = {"candidates": []}
     for result in json.loads(response.text)["results"]:
@@ -130,7 +130,7 @@ def get_place_details(place_id: str):
     """
 
     url = f"https://maps.googleapis.com/maps/api/place/details/json?place_id={place_id}&key={keys.gmaps_key}"
-    response = requests.get(url)
+    response = get_http_client().get(url)
     result = json.loads(response.text)["result"]
 
     formatted_result = {
@@ -160,7 +160,7 @@ def get_travel_distance(origin: str, destination: str, mode: str):
 
 
     url = f"https://maps.googleapis.com/maps/api/distancematrix/json?origins={origin}&destinations={destination}&mode={mode}&units=imperial&key={keys.gmaps_key}"
-    response = requests.get(url)
+    response = get_http_client().get(url)
     result = json.loads(response.text)["rows"][0]["elements"][0]
 
     if result["status"] != "OK":
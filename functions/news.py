@@ -1,7 +1,7 @@
 import secret.keys as keys
 from src.gpt_function import gpt_function
 import json
-import requests
+from src.http_client import get_http_client
 import datetime
 
 @gpt_function
@@ -12,7 +12,7 @@ def get_news_headlines(topic: str):
     """
 
     url = f"https://newsdata.io/api/1/news?apikey={keys.news_key}&q={topic}"
-    response = requests.get(url)
+    response = get_http_client().get(url)
     json_data = json.loads(response.text)
 
     articles = []
@@ -38,7 +38,7 @@ def get_full_article(headline: str):
     """
 
     url = f"https://newsdata.io/api/1/news?apikey={keys.news_key}&q={headline}"
-    response = requests.get(url)
+    response = get_http_client().get(url)
     json_data = json.loads(response.text)
 
     article = json_data["results"][0]
@@ -0,0 +1,14 @@
+from src.gpt_function import gpt_function
+from src.governor import get_page
+
+
+@gpt_function
+def read_more(continuation: str, page: int):
+    """
+    Useful for reading more of a function result that was too long to return whole.
+    Only use this if the part of the result you already have is not enough.
+    :param continuation: the continuation of the result, given with its first part
+    :param page: the number of the page to read, starting from 1. If the result was cut down to its first page,
+    that page was already given, if it was summarized none of its pages were.
+    """
+    return get_page(continuation, page)
@@ -1,7 +1,7 @@
 import json
 
 from secret import keys
-import requests
+from src.http_client import get_http_client
 from src.gpt_function import gpt_function
 import streamlit as st
 
@@ -15,9 +15,9 @@ def search_places(query: str, category: str = ""):
     """
 
     if category == "":
-        response = requests.get(f"https://api.content.tripadvisor.com/api/v1/location/search?key={keys.tripadvisor_key}&searchQuery={query}")
+        response = get_http_client().get(f"https://api.content.tripadvisor.com/api/v1/location/search?key={keys.tripadvisor_key}&searchQuery={query}")
     else:
-        response = requests.get(f"https://api.content.tripadvisor.com/api/v1/location/search?key={keys.tripadvisor_key}&searchQuery={query}&category={category}")
+        response = get_http_client().get(f"https://api.content.tripadvisor.com/api/v1/location/search?key={keys.tripadvisor_key}&searchQuery={query}&category={category}")
 
     results = json.loads(response.text)["data"]
 
@@ -45,7 +45,7 @@ def find_nearby(category:str):
     # Get rounded lat and long
     latlong = f"{round(raw_location['latitude'], 6)},{round(raw_location['longitude'], 6)}"
 
-    response = requests.get(f"https://api.content.tripadvisor.com/api/v1/location/nearby_search?latLong={latlong}&key={keys.tripadvisor_key}&category={category}")
+    response = get_http_client().get(f"https://api.content.tripadvisor.com/api/v1/location/nearby_search?latLong={latlong}&key={keys.tripadvisor_key}&category={category}")
 
     results = json.loads(response.text)["data"]
 
@@ -1,7 +1,7 @@
 import secret.keys as keys
 from src.gpt_function import gpt_function
 import json
-import requests
+from src.http_client import get_http_client
 import datetime
 
 @gpt_function
@@ -12,7 +12,7 @@ def get_weather(location: str, day: str):
     :param day: the day to get the weather for. 'yyyy-mm-dd' format.
     """
     url = f"https://api.weatherapi.com/v1/forecast.json?key={keys.weather_key}&q={location}&dt={day}&aqi=no"
-    response = requests.get(url)
+    response = get_http_client().get(url)
     json_data = json.loads(response.text)
 
     forecast = {
@@ -1,7 +1,10 @@
 import streamlit as st
 import data.core as core
 import pandas as pd
+import os
+import yaml
 from agents.basic import describe_dataframe
+from data.ingest import read_csv_chunked
 
 st.set_page_config(
     page_title="Data View",
@@ -29,12 +32,28 @@ uploaded_file = st.file_uploader("Upload data",
                                  key="data_upload",
                                  label_visibility="collapsed")
 if uploaded_file is not None:
-    dataframe = pd.read_csv(uploaded_file)
-    name = uploaded_file.name.replace(".csv", "")
+    name = os.path.splitext(uploaded_file.name)[0]
+    workbook = None
+    if uploaded_file.name.lower().endswith(".xlsx"):
+        # Only the sheet names are read here, a sheet is only parsed once it is selected
+        workbook = pd.ExcelFile(uploaded_file)
+        sheet = workbook.sheet_names[0]
+        if len(workbook.sheet_names) > 1:
+            sheet = st.selectbox("Sheet to load", workbook.sheet_names)
+            name = f"{name} - {sheet}"
+
     if name not in st.session_state["data"]:
-        with st.spinner("Processing..."):
-            summary = describe_dataframe(name, dataframe)
-        core.save_new_data(dataframe, name, summary)
+        progress = st.progress(0.0, text=f"Loading {name}...")
+        if workbook is not None:
+            dataframe = workbook.parse(sheet)
+        else:
+            config = yaml.safe_load(open("config.yaml", "r"))["data"]
+            dataframe = read_csv_chunked(uploaded_file, lambda done: progress.progress(done, text=f"Loading {name}..."),
+                                         downcast=config["optimize_dtypes"] and config["downcast_numbers"])
+        progress.progress(1.0, text=f"Loaded {name}")
+        # Register the data straight away, the summary is generated in the background
+        core.save_new_data(dataframe, name, "The summary is still being generated.")
+        core.summarize_async(name, describe_dataframe)
         st.experimental_rerun()
 
 if data_name is not None:
@@ -0,0 +1,262 @@
+import json
+import enum
+import types
+import typing
+import inspect
+
+try:
+    from typing import is_typeddict
+except ImportError:
+    is_typeddict = None
+
+_TRUE = {"true", "yes", "y", "1", "on"}
+_FALSE = {"false", "no", "n", "0", "off", ""}
+
+
+class ArgumentError(Exception):
+    """
+    Raised when an argument from the LLM does not match the type of its parameter.
+    """
+
+    def __init__(self, path: str, message: str):
+        super().__init__(f"{path}: {message}")
+        self.path = path
+        self.message = message
+
+
+def _loads(value, expected: type):
+    """
+    Parses a JSON string the LLM gave in place of a list or an object.
+    :param value: the value
+    :param expected: the type the value should have once parsed
+    :return: the parsed value, or the value itself if it is not such a string
+    """
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            return value
+        if isinstance(parsed, expected):
+            return parsed
+    return value
+
+
+def _string(value, path: str):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (bool, int, float)):
+        return str(value)
+    raise ArgumentError(path, f"expected a string, got {json.dumps(value)}")
+
+
+def _integer(value, path: str):
+    if isinstance(value, bool):
+        raise ArgumentError(path, f"expected an integer, got {json.dumps(value)}")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            number = float(value.strip())
+            if number.is_integer():
+                return int(number)
+        except ValueError:
+            pass
+    raise ArgumentError(path, f"expected an integer, got {json.dumps(value)}")
+
+
+def _number(value, path: str):
+    if isinstance(value, bool):
+        raise ArgumentError(path, f"expected a number, got {json.dumps(value)}")
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip())
+        except ValueError:
+            pass
+    raise ArgumentError(path, f"expected a number, got {json.dumps(value)}")
+
+
+def _boolean(value, path: str):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in _TRUE | _FALSE:
+        return value.strip().lower() in _TRUE
+    raise ArgumentError(path, f"expected true or false, got {json.dumps(value)}")
+
+
+def passthrough(value, path: str):
+    return value
+
+
+_SCALARS = {
+    str: ({"type": "string"}, _string),
+    int: ({"type": "integer"}, _integer),
+    float: ({"type": "number"}, _number),
+    bool: ({"type": "boolean"}, _boolean),
+}
+
+
+def compile_annotation(annotation) -> tuple[dict, callable]:
+    """
+    Compiles the JSON schema and the coercer for a type annotation.
+    Supports str, int, float, bool, lists, dicts, TypedDicts, Literals, Enums and Optional types, nested in any way.
+    Anything else is described as a string and passed through as it is.
+    The coercer takes the value from the LLM and the path of the argument, for errors,
+    and returns the value converted to the annotated type or raises an ArgumentError.
+    :param annotation: the annotation
+    :return: the schema and the coercer
+    """
+    if annotation is inspect.Parameter.empty or annotation is typing.Any:
+        return {"type": "string"}, passthrough
+
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin in (typing.Union, types.UnionType):
+        options = [arg for arg in args if arg is not type(None)]
+        if len(options) != 1:
+            # Unions of several types are not described to the LLM, it gets the first one
+            return compile_annotation(options[0])
+        schema, inner = compile_annotation(options[0])
+
+        def optional(value, path: str):
+            if value is None:
+                return None
+            return inner(value, path)
+        return schema, optional
+
+    if origin is typing.Literal:
+        values = list(args)
+        schema = {"enum": values}
+        if all(isinstance(value, str) for value in values):
+            schema["type"] = "string"
+        elif all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            schema["type"] = "integer"
+        return schema, _enum(values, values)
+
+    if inspect.isclass(annotation) and issubclass(annotation, enum.Enum):
+        members = list(annotation)
+        values = [member.value for member in members]
+        schema = {"enum": values}
+        if all(isinstance(value, str) for value in values):
+            schema["type"] = "string"
+        return schema, _enum(values, members)
+
+    if annotation in _SCALARS:
+        schema, coerce = _SCALARS[annotation]
+        return dict(schema), coerce
+
+    if annotation is list or origin is list:
+        items_schema, items = compile_annotation(args[0]) if args else ({"type": "string"}, passthrough)
+
+        def array(value, path: str):
+            value = _loads(value, list)
+            if not isinstance(value, list):
+                raise ArgumentError(path, f"expected a list, got {json.dumps(value)}")
+            return [items(item, f"{path}[{index}]") for index, item in enumerate(value)]
+        return {"type": "array", "items": items_schema}, array
+
+    if is_typeddict is not None and is_typeddict(annotation):
+        return _compile_typeddict(annotation)
+
+    if annotation is dict or origin is dict:
+        schema = {"type": "object"}
+        values = passthrough
+        if len(args) == 2:
+            schema["additionalProperties"], values = compile_annotation(args[1])
+
+        def mapping(value, path: str):
+            value = _loads(value, dict)
+            if not isinstance(value, dict):
+                raise ArgumentError(path, f"expected an object, got {json.dumps(value)}")
+            return {key: values(item, f"{path}.{key}") for key, item in value.items()}
+        return schema, mapping
+
+    return {"type": "string"}, passthrough
+
+
+def _enum(values: list, results: list) -> callable:
+    """
+    Creates the coercer for a fixed set of values.
+    Strings are matched ignoring case, and numbers given as strings are matched to the numbers.
+    :param values: the allowed values
+    :param results: what each allowed value is converted to
+    :return: the coercer
+    """
+    lookup = {}
+    for value, result in zip(values, results):
+        lookup[json.dumps(value)] = result
+        if isinstance(value, str):
+            lookup.setdefault(json.dumps(value.lower()), result)
+        else:
+            lookup.setdefault(json.dumps(str(value)), result)
+
+    def coerce(value, path: str):
+        for candidate in (value, value.lower() if isinstance(value, str) else value):
+            key = json.dumps(candidate)
+            if key in lookup:
+                return lookup[key]
+        raise ArgumentError(path, f"expected one of {json.dumps(values)}, got {json.dumps(value)}")
+    return coerce
+
+
+def _compile_typeddict(annotation) -> tuple[dict, callable]:
+    """
+    Compiles a TypedDict into an object schema with its fields, and the coercer checking them.
+    :param annotation: the TypedDict
+    :return: the schema and the coercer
+    """
+    hints = typing.get_type_hints(annotation)
+    required = [name for name in hints if name in annotation.__required_keys__]
+    properties = {}
+    fields = {}
+    for name, hint in hints.items():
+        properties[name], fields[name] = compile_annotation(hint)
+    schema = {"type": "object", "properties": properties, "required": required}
+
+    def structure(value, path: str):
+        value = _loads(value, dict)
+        if not isinstance(value, dict):
+            raise ArgumentError(path, f"expected an object, got {json.dumps(value)}")
+        missing = [name for name in required if name not in value]
+        if missing:
+            raise ArgumentError(path, f"missing the fields {missing}")
+        unknown = [name for name in value if name not in fields]
+        if unknown:
+            raise ArgumentError(path, f"unknown fields {unknown}, the fields are {list(fields)}")
+        return {name: fields[name](item, f"{path}.{name}") for name, item in value.items()}
+    return schema, structure
+
+
+def compile_validator(coercers: dict, required: list) -> callable:
+    """
+    Compiles the validator for the arguments of a function.
+    :param coercers: the coercer of each parameter, by name
+    :param required: the names of the required parameters
+    :return: a function taking the arguments from the LLM and returning the coerced arguments and a list of errors,
+    each error a dict with the argument and what is wrong with it
+    """
+    required = list(required)
+
+    def validate(args: dict) -> tuple[dict, list]:
+        errors = []
+        result = {}
+        for name in required:
+            if name not in args:
+                errors.append({"argument": name, "error": "missing a required argument"})
+        for name, value in args.items():
+            coerce = coercers.get(name)
+            if coerce is None:
+                errors.append({"argument": name, "error": f"unknown argument, the arguments are {list(coercers)}"})
+                continue
+            try:
+                result[name] = coerce(value, name)
+            except ArgumentError as e:
+                errors.append({"argument": e.path, "error": e.message})
+        return result, errors
+    return validate
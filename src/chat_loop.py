@@ -1,16 +1,18 @@
 import streamlit as st
-import openai
-import secret.keys as keys
 from src.conversator import Conversator
+from src.context import ContextOverflow
 from functions.weather import get_weather
 from functions.news import get_news_headlines, get_full_article
 from functions.gmaps import lookup_physical_place, get_place_details, get_travel_distance
 from functions.basic import get_basic_info
+from functions.results import read_more
 from data.storage import manual_write_data, get_data_details
 from data.manipulation import analyze_data, transform_data, undo_transformation
 from agents.basic import run_on_list
 from agents.talkback_agent import complete_task
 from data.plotting import plot_data
+from data.query import query_data
+from data.workers import get_pool
 import traceback
 import streamlit_js_eval as stjs
 
@@ -25,7 +27,6 @@ class Chat:
 
     def run(self):
         st.session_state.raw_geo = stjs.get_geolocation()
-        openai.api_key = keys.openai_key
 
         # Initialize the conversator and save it to the session state
         if "conversator" not in st.session_state:
@@ -42,8 +43,12 @@ class Chat:
                 #get_cik, get_company_info, get_company_filings, get_full_filing,
                 plot_data,
                 get_data_details,
+                query_data,
                 analyze_data, transform_data, undo_transformation,
+                read_more,
             ])
+            # Start the data workers now so that they are warm by the first data call
+            get_pool()
 
         # Print all the messages
         with st.container():
@@ -60,6 +65,10 @@ class Chat:
                 with st.chat_message("user"):
                     st.markdown(prompt)
 
+                with st.chat_message("assistant"):
+                    # The response is streamed into this placeholder as it is generated
+                    placeholder = st.empty()
+                    # Each attempt resumes the turn from its last completed step
                     attempts = 0
                     success = False
                     while not success:
@@ -70,13 +79,18 @@ class Chat:
                             st.stop()
                             break
                         try:
-                            response = st.session_state.conversator.process_msg(prompt)
+                            response = st.session_state.conversator.process_msg(prompt, placeholder)
                             success = True
+                        except ContextOverflow:
+                            # Trying again would not make the request any smaller
+                            traceback.print_exc()
+                            st.session_state.conversator.reset_to_last()
+                            st.error("The request is too long for the model, please shorten it or start over.")
+                            st.stop()
                         except Exception as e:
                             print("\n\n---------------------------------------------")
                             traceback.print_exc()
                             print("---------------------------------------------\n\n")
 
 
-                with st.chat_message("assistant"):
-                    st.markdown(response)
\ No newline at end of file
+                    placeholder.markdown(response)
\ No newline at end of file
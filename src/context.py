@@ -0,0 +1,262 @@
+import json
+import yaml
+from src.llm import get_llm_client
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# The tokens every message costs on top of its content
+_MESSAGE_OVERHEAD = 4
+# The number of counted texts kept, so unchanged messages are not counted again on every request
+_CACHE_SIZE = 4096
+
+
+class ContextOverflow(Exception):
+    """
+    Raised when the messages cannot be compacted to fit in the token budget.
+    """
+
+
+class ContextManager:
+    """
+    Keeps the messages sent to the LLM within a token budget.
+    Before each request, the results of function calls in older turns are truncated, or summarized, oldest first.
+    If that is not enough, the oldest turns are dropped entirely.
+    The most recent turns are only changed once the older ones are used up: their function results are shortened,
+    largest first, and then all but the last turn are dropped.
+    The system prompt and the last turn's first message, the request itself, are never changed.
+    A turn starts with a user message, or with a system prompt after the first one, as agents use them for each step.
+    """
+
+    def __init__(self, model: str, budget: int, keep_recent_turns: int = 2, truncate_tokens: int = 200,
+                 summarize: callable = None):
+        self.model = model
+        self.budget = budget
+        self.keep_recent_turns = keep_recent_turns
+        self.truncate_tokens = truncate_tokens
+        self.summarize = summarize
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except Exception:
+                try:
+                    self.encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    self.encoding = None
+        self.counts = {}
+
+    def count_text(self, text: str) -> int:
+        """
+        Counts the tokens in a text.
+        Estimated at four characters per token if tiktoken is not available.
+        :param text: the text
+        :return: the number of tokens
+        """
+        if not text:
+            return 0
+        if text not in self.counts:
+            if len(self.counts) >= _CACHE_SIZE:
+                self.counts.clear()
+            if self.encoding is not None:
+                self.counts[text] = len(self.encoding.encode(text, disallowed_special=()))
+            else:
+                self.counts[text] = len(text) // 4 + 1
+        return self.counts[text]
+
+    def count(self, message: dict) -> int:
+        """
+        Counts the tokens of a single message, including its function or tool calls.
+        :param message: the message
+        :return: the number of tokens
+        """
+        tokens = _MESSAGE_OVERHEAD + self.count_text(message.get("content")) + self.count_text(message.get("name"))
+        if message.get("function_call"):
+            tokens += self.count_text(message["function_call"]["name"])
+            tokens += self.count_text(message["function_call"]["arguments"])
+        for call in message.get("tool_calls") or []:
+            tokens += self.count_text(call["function"]["name"]) + self.count_text(call["function"]["arguments"])
+        return tokens
+
+    def split_text(self, text: str, max_tokens: int) -> list[str]:
+        """
+        Splits a text into consecutive parts of at most a number of tokens.
+        Estimated at four characters per token if tiktoken is not available.
+        :param text: the text
+        :param max_tokens: the maximum number of tokens of a part
+        :return: the parts, at least one
+        """
+        if self.encoding is None:
+            size = max_tokens * 4
+            return [text[start:start + size] for start in range(0, len(text), size)] or [""]
+        tokens = self.encoding.encode(text, disallowed_special=())
+        return [self.encoding.decode(tokens[start:start + max_tokens])
+                for start in range(0, len(tokens), max_tokens)] or [""]
+
+    def _turn_starts(self, messages: list) -> list[int]:
+        """
+        Finds the index of the first message of every turn.
+        :param messages: the messages
+        :return: the indices, in order
+        """
+        return [index for index, message in enumerate(messages)
+                if index > 0 and message["role"] in ("user", "system")]
+
+    def _compact(self, message: dict) -> dict:
+        """
+        Shortens the result of a function call.
+        :param message: the message with the result
+        :return: a copy of the message with the shortened result
+        """
+        content = message["content"]
+        tokens = self.count_text(content)
+        if self.summarize is not None:
+            try:
+                summary = self.summarize(content)
+                return {**message, "content": f"[Summary of an earlier result of {tokens} tokens] {summary}"}
+            except Exception:
+                pass
+        if self.encoding is not None:
+            head = self.encoding.decode(self.encoding.encode(content, disallowed_special=())[:self.truncate_tokens])
+        else:
+            head = content[:self.truncate_tokens * 4]
+        return {**message, "content": f"{head}\n[... an earlier result truncated from {tokens} tokens ...]"}
+
+    def fit(self, messages: list, extra: list = None, functions: list = None, function_tokens: int = None) -> list:
+        """
+        Compacts the messages in place until they fit in the budget.
+        Messages are only ever removed from the start of the history, right after the system prompt,
+        so an index into the history stays valid once moved back by the number of messages removed.
+        Raises a ContextOverflow if the messages cannot be made to fit, rather than sending an over-budget request.
+        :param messages: the history of messages, compacted in place
+        :param extra: messages sent after the history but not kept in it, e.g. the available data, optional
+        :param functions: the function schemas sent with the request, they count towards the budget, optional
+        :param function_tokens: the tokens of the function schemas if already counted, instead of the schemas, optional
+        :return: the messages to send, the history followed by the extra messages
+        """
+        extra = extra or []
+        reserved = sum(self.count(message) for message in extra)
+        if function_tokens is not None:
+            reserved += function_tokens
+        elif functions:
+            reserved += self.count_text(json.dumps(functions))
+        used = reserved + sum(self.count(message) for message in messages)
+        if used <= self.budget:
+            return messages + extra
+
+        starts = self._turn_starts(messages)
+        # Everything from the start of the most recent turns onwards is kept as it is
+        protected = len(messages)
+        if self.keep_recent_turns > 0 and starts:
+            protected = starts[-self.keep_recent_turns:][0]
+
+        # Shorten the results of older function calls, oldest first
+        used = self._shorten(messages, range(1, protected), used)
+        # Drop whole older turns, oldest first, so that calls and their results stay together
+        used, starts, protected = self._drop_turns(messages, starts, protected, used)
+
+        if used > self.budget:
+            # The recent turns have to give way too, their largest results first, then all but the last turn
+            recent = sorted(range(protected, len(messages)), key=lambda index: -self.count(messages[index]))
+            used = self._shorten(messages, recent, used)
+            if starts:
+                used, starts, protected = self._drop_turns(messages, starts, starts[-1], used)
+
+        if used > self.budget:
+            raise ContextOverflow(f"The request needs {used} tokens after compaction, "
+                                  f"over the budget of {self.budget} tokens")
+        return messages + extra
+
+    def _shorten(self, messages: list, indices, used: int) -> int:
+        """
+        Shortens the results of function calls in place, in the given order, until the messages fit in the budget.
+        :param messages: the messages
+        :param indices: the indices of the messages to shorten, in order
+        :param used: the tokens used so far
+        :return: the tokens used after shortening
+        """
+        for index in indices:
+            if used <= self.budget:
+                break
+            message = messages[index]
+            if message["role"] not in ("function", "tool") or not message.get("content"):
+                continue
+            if self.count_text(message["content"]) <= self.truncate_tokens:
+                continue
+            compacted = self._compact(message)
+            used += self.count(compacted) - self.count(message)
+            messages[index] = compacted
+        return used
+
+    def _drop_turns(self, messages: list, starts: list, protected: int, used: int) -> tuple[int, list, int]:
+        """
+        Drops whole turns in place, oldest first, until the messages fit in the budget or the protected turns are reached.
+        :param messages: the messages
+        :param starts: the index of the first message of every turn
+        :param protected: the index from which no message may be dropped
+        :param used: the tokens used so far
+        :return: the tokens used, the turn starts and the protected index after dropping
+        """
+        while used > self.budget and starts and starts[0] < protected:
+            # Anything between the system prompt and the first turn is dropped with it
+            end = starts[1] if len(starts) > 1 else protected
+            used -= sum(self.count(message) for message in messages[1:end])
+            del messages[1:end]
+            removed = end - 1
+            starts = [start - removed for start in starts[1:]]
+            protected -= removed
+        return used, starts, protected
+
+
+def _summarizer(model: str) -> callable:
+    """
+    Creates a function that summarizes the result of a function call with the LLM.
+    :param model: the name of the model to use
+    :return: the summarize function
+    """
+    def summarize(text: str) -> str:
+        response = get_llm_client().complete(
+            "summarize_result",
+            model=model,
+            messages=[
+                {"role": "system", "content": "Summarize the following function result in a few sentences. "
+                                              "Keep all names, numbers and ids that may be needed later."},
+                {"role": "user", "content": text},
+            ],
+        )
+        return response["content"]
+    return summarize
+
+
+def get_context_manager(model: str) -> ContextManager:
+    """
+    Creates a context manager with the budget configured for a model.
+    :param model: the name of the model
+    :return: the context manager
+    """
+    config = yaml.safe_load(open("config.yaml", "r"))["context"]
+    summarize = _summarizer(model) if config["summarize_results"] else None
+    return ContextManager(
+        model=model,
+        budget=config["budgets"].get(model, config["default_budget"]),
+        keep_recent_turns=config["keep_recent_turns"],
+        truncate_tokens=config["truncate_tokens"],
+        summarize=summarize,
+    )
+
+
+_counter = None
+
+
+def get_token_counter() -> ContextManager:
+    """
+    Get a context manager for the main model shared by everything that only counts or splits text,
+    so that the counts are cached in one place.
+    :return: the context manager
+    """
+    global _counter
+    if _counter is None:
+        _counter = get_context_manager(yaml.safe_load(open("config.yaml", "r"))["model"]["main"])
+    return _counter
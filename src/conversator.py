@@ -1,9 +1,21 @@
-import openai
-from secret import keys
 import json
+import asyncio
+import contextlib
+import functools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import data.core as core
 from src.gpt_function import GPTFunction
+from src.streaming import StreamAssembler
+from src.context import get_context_manager
+from src.tool_registry import get_tool_registry
+from src.retries import MalformedArguments, with_retries, get_retry_policies
+from src.llm_cache import get_llm_cache, cache_enabled
+from src.llm import get_llm_client
+from src.event_loop import submit
 import yaml
 
 # unused_email_prompt = """Emails must absolutely always use html for formatting.
@@ -42,7 +54,6 @@ class Conversator:
 
     def __init__(self, functions: list):
         self.all_functions = functions
-        openai.api_key = keys.openai_key
         self.internal_messages = [{"role": "system", "content": _starter_prompt}]
         self.last_internal_msg_len = 1
         self.functions = {}
@@ -52,75 +63,402 @@ class Conversator:
 
         config = yaml.safe_load(open("config.yaml"))
         self.model_name = config["model"]["main"]
+        self.stream = config["model"]["stream"]
+        # Tool calls let the model make several calls in one turn, instead of a single function call
+        self.tool_calls = config["model"]["tool_calls"]
+        self.executor = ThreadPoolExecutor(max_workers=config["model"]["max_parallel_calls"])
+        # Keeps the messages sent within the token budget of the model
+        self.context = get_context_manager(self.model_name)
+        # Serializes the function schemas once and picks the ones relevant to each request
+        self.registry = get_tool_registry(functions, self.context.count_text)
+        # The timing of every streamed completion
+        self.stream_stats = []
+        # The calls already started while their message was still streaming, by call key
+        self.pending = {}
+        # The last call on the data store started in this turn, calls on the data run one after another
+        self.data_tail = None
+        self.retry_policies = get_retry_policies()
+        # The checkpoint of the turn being processed, so that a failed turn resumes from its last completed step.
+        # Holds the user message, the last message from the LLM whose calls are not finished, and their results so far
+        self.turn = None
 
-    def process_msg(self, msg: str) -> str:
+    def complete(self, extra: list = None, placeholder=None) -> dict:
+        """
+        Gets the next message from the LLM, retrying failures according to the policy for their class.
+        A message with malformed call arguments is requested again, unless some of its calls have already started.
+        If the retries for that run out, the message is returned and its calls return the error to the LLM.
+        :param extra: messages to send after the internal messages without keeping them, optional
+        :param placeholder: a streamlit element to render the content into, optional
+        :return: the message returned by the LLM
+        """
+        try:
+            return with_retries(lambda: self._complete_once(extra, placeholder), self.retry_policies)
+        except MalformedArguments as e:
+            return e.message
+
+    def _complete_once(self, extra: list = None, placeholder=None) -> dict:
+        """
+        Makes a single request for the next message from the LLM.
+        The internal messages are compacted to fit in the token budget first.
+        When streaming, the content is rendered into the placeholder as it arrives.
+        The preparatory work for each argument of a streamed call is started as soon as the argument is complete,
+        and the call itself is started as soon as all its arguments are.
+        A single function call is returned straight away then, without waiting for the rest of the stream.
+        If the stream fails after calls have started, the message is returned with just those calls instead of
+        being requested again, as a new message would have new calls and the started ones would be made twice.
+        Responses are cached, a cached response is returned whole instead of being streamed.
+        :param extra: messages to send after the internal messages without keeping them, optional
+        :param placeholder: a streamlit element to render the content into, optional
+        :return: the message returned by the LLM
+        """
+        # Calls started by an earlier attempt that never returned its message will not be used
+        if self.pending:
+            print(f"\nDiscarding {len(self.pending)} calls started by a failed request")
+            for future in self.pending.values():
+                if future is not None:
+                    future.cancel()
+            self.pending = {}
+            self.data_tail = None
+
+        names = self.registry.select(self.internal_messages)
+        if self.tool_calls:
+            tools = {"tools": self.registry.tool_schemas(names), "tool_choice": "auto"}
+        else:
+            tools = {"functions": self.registry.function_schemas(names), "function_call": "auto"}
+        length = len(self.internal_messages)
+        request = dict(
+            model=self.model_name,
+            messages=self.context.fit(self.internal_messages, extra, function_tokens=self.registry.count(names)),
+            **tools
+        )
+        # Compaction drops old turns from the start of the history, so the point to reset to moves back with them
+        removed = length - len(self.internal_messages)
+        self.last_internal_msg_len = max(1, self.last_internal_msg_len - removed)
+        cache = cache_enabled("conversator")
+        if cache:
+            message = get_llm_cache().get(request, "conversator")
+            if message is not None:
+                if placeholder is not None and message.get("content"):
+                    placeholder.markdown(message["content"])
+                return message
+
+        response = get_llm_client().create(stream=self.stream, **request)
+        if not self.stream:
+            message = response["choices"][0]["message"]
+            if not self._arguments_valid(message):
+                raise MalformedArguments(message)
+            if cache:
+                get_llm_cache().put(request, message)
+            return message
+
+        assembler = StreamAssembler()
+        preparing = {}
+        started = []
+        try:
+            # Closed as soon as it is left, the stream holds a slot of the concurrency limit until then
+            with contextlib.closing(response):
+                for chunk in response:
+                    delta = assembler.add(chunk)
+                    if placeholder is not None and delta.get("content"):
+                        placeholder.markdown(assembler.content + "▌")
+                    for index, argument, value in assembler.new_arguments:
+                        function = self.functions.get(assembler.calls[index]["name"])
+                        thread = function.prepare(argument, value) if function is not None else None
+                        if thread is not None:
+                            preparing.setdefault(index, []).append(thread)
+                    for index in assembler.completed_calls:
+                        call = self._unpack(assembler.call(index))
+                        self.pending[call["key"]] = self._dispatch(call, preparing.get(index, []))
+                        started.append(index)
+                    # The name arrives whole in the first delta of a call, so an unknown function can be rejected straight away
+                    if not self.tool_calls and assembler.calls and \
+                            (assembler.arguments_complete or assembler.calls[0]["name"] not in self.functions):
+                        break
+        except Exception as e:
+            if not started:
+                raise
+            # The calls already running are kept, the LLM is asked for the rest once their results are in
+            print(f"\nStream failed after {len(started)} calls started ({e}), continuing with those calls")
+            message = {"role": assembler.role, "content": assembler.content or None}
+            if self.tool_calls:
+                message["tool_calls"] = [assembler.call(index) for index in started]
+            else:
+                message["function_call"] = assembler.call(started[0])
+            return message
+        assembler.finish()
+        stats = assembler.stats()
+        self.stream_stats.append(stats)
+        print(f"\nStreamed {stats['tokens']} tokens, first token after {stats['time_to_first_token']}s, "
+              f"{stats['tokens_per_second']} tokens/s")
+        message = assembler.message()
+        valid = self._arguments_valid(message)
+        if not valid and not started:
+            raise MalformedArguments(message)
+        # A stream left early for an unknown function is not a whole response
+        if cache and valid and (assembler.finish_reason is not None or assembler.arguments_complete):
+            get_llm_cache().put(request, message)
+        return message
+
+    def _arguments_valid(self, message: dict) -> bool:
+        """
+        Checks that the arguments of every call in a message are a valid JSON object.
+        :param message: the message from the LLM
+        :return: True if all the arguments are valid
+        """
+        calls = message.get("tool_calls") or ([message["function_call"]] if message.get("function_call") else [])
+        return all(isinstance(self._unpack(call)["args"], dict) for call in calls)
+
+    def process_msg(self, msg: str, placeholder=None) -> str:
         """
         Process a single message from the user.
-        Either return a response or call a function until the LLM returns a response.
+        Either return a response or call functions until the LLM returns a response.
+        The turn is checkpointed after every message from the LLM and every function result.
+        If it is processed again after a failure, it resumes from the last completed step instead of starting over.
         :param msg: The message from the user
+        :param placeholder: a streamlit element to stream the response into, optional
         :return: The final response to the user
         """
-        st.session_state["messages"].append({"role": "user", "content": msg})
-        self.internal_messages.append({"role": "user", "content": msg})
-        available_data = {}
-        for name, data in core.get_all_data_details().items():
-            available_data[name] = data["summary"]
-        available_data = json.dumps(available_data, indent=4)
-        data_message = [{"role": "system", "content": f"Data available from storage:\n{available_data}"}]
-        with st.spinner("Thinking..."):
-            response = openai.ChatCompletion.create(
-                model=self.model_name,
-                messages=self.internal_messages + data_message,
-                functions=list(map(lambda x: x.to_dict(), self.functions.values())),
-                function_call="auto"
-            )
-        message = response["choices"][0]["message"]
-
-        while message.get("function_call"):
-            func_name = message["function_call"]["name"]
-            print(message["function_call"]["arguments"])
-            func_args = json.loads(message["function_call"]["arguments"])
-            if "reason" not in func_args:
-                func_args["reason"] = "Working on it..."
-
-            message = self.call_function(func_name, func_args)
+        if self.turn is None or self.turn["msg"] != msg:
+            self.turn = {"msg": msg, "message": None, "results": {}}
+            self.pending = {}
+            self.data_tail = None
+            st.session_state["messages"].append({"role": "user", "content": msg})
+            self.internal_messages.append({"role": "user", "content": msg})
+        else:
+            print("\nResuming the turn from its last completed step")
+
+        while True:
+            if self.turn["message"] is None:
+                # The data available is only sent with the first request of the turn
+                extra = self._data_message() if self.internal_messages[-1]["role"] == "user" else None
+                with st.spinner("Thinking..."):
+                    self.turn["message"] = self.complete(extra, placeholder)
+            message = self.turn["message"]
+            if not (message.get("function_call") or message.get("tool_calls")):
+                break
+            self.call_functions(message)
 
         st.session_state["messages"].append(message)
         self.internal_messages.append(message)
+        self.turn = None
 
         self.last_msg_len = len(st.session_state["messages"])
         self.last_internal_msg_len = len(self.internal_messages)
         return message["content"]
 
-    def call_function(self, func_name: str, args: dict):
+    def _data_message(self) -> list:
+        """
+        Get the message listing the data available from storage.
+        :return: the message, in a list
+        """
+        available_data = {}
+        for name, data in core.get_all_data_details().items():
+            available_data[name] = data["summary"]
+        available_data = json.dumps(available_data, indent=4)
+        return [{"role": "system", "content": f"Data available from storage:\n{available_data}"}]
+
+    def _unpack(self, call: dict) -> dict:
+        """
+        Gets the details of a tool call or a legacy function call.
+        :param call: the call, as in the message from the LLM
+        :return: the key identifying the call, its id, function name, raw and parsed arguments and reason
+        """
+        function = call.get("function", call)
+        try:
+            args = json.loads(function["arguments"] or "{}")
+        except ValueError:
+            args = None
+        reason = "Working on it..."
+        if isinstance(args, dict) and args.get("reason"):
+            reason = args["reason"]
+        return {
+            "key": call.get("id") or "function_call",
+            "id": call.get("id"),
+            "name": function["name"],
+            "arguments": function["arguments"],
+            "args": args,
+            "reason": reason,
+        }
+
+    def _check_call(self, call: dict) -> str | None:
+        """
+        Checks that a call can be made.
+        :param call: the unpacked call
+        :return: the error to return to the LLM as a JSON string, or None if the call can be made
+        """
+        if call["name"] not in self.functions:
+            return json.dumps({"error": f"There is no function called '{call['name']}'. Only use the functions provided."})
+        if not isinstance(call["args"], dict):
+            return json.dumps({"error": f"The arguments are not a valid JSON object: {call['arguments']}"})
+        return None
+
+    def _run_call(self, call: dict) -> str:
+        """
+        Makes a single call.
+        Errors are returned as the result of the call, so that a failing call does not affect the others.
+        :param call: the unpacked call
+        :return: the result of the call as a JSON string
+        """
+        error = self._check_call(call)
+        if error is not None:
+            return error
+        func = self.functions[call["name"]]
+        print(call["arguments"])
+        args = dict(call["args"])
+        args["reason"] = call["reason"]
+        try:
+            return func(args)
+        except Exception as e:
+            traceback.print_exc()
+            return json.dumps({"error": f"The function '{func.name}' failed: {e}"})
+
+    async def _arun_call(self, call: dict, context=None) -> str:
+        """
+        Makes a single call of an async function on the shared event loop.
+        Errors are returned as the result of the call, so that a failing call does not affect the others.
+        :param call: the unpacked call
+        :param context: the script run context of the session
+        :return: the result of the call as a JSON string
+        """
+        error = self._check_call(call)
+        if error is not None:
+            return error
+        func = self.functions[call["name"]]
+        print(call["arguments"])
+        args = dict(call["args"])
+        args["reason"] = call["reason"]
+        try:
+            return await func.acall(args, context)
+        except Exception as e:
+            traceback.print_exc()
+            return json.dumps({"error": f"The function '{func.name}' failed: {e}"})
+
+    def _dispatch(self, call: dict, preparing: list = ()) -> Future | None:
         """
-        Calls a function with the parameters given.
-        Sends the result to the LLM and returns the response.
-        :param func: the function to call
-        :param args: the arguments of the function to call
+        Starts a call, async functions on the shared event loop and the rest on the thread pool.
+        Calls on the data store are chained, so that they run one at a time in the order the LLM made them.
+        Any of them may read or write any dataset, e.g. a query joining tables or a result saved under a new name.
+        :param call: the unpacked call
+        :param preparing: the threads doing the preparatory work for the call, waited for before the call is made
+        :return: the future result of the call, or None if the call has to be made from the script thread.
+        This is the case for agents, which draw their own progress and make calls of their own.
         """
-        func = self.functions[func_name]
-        reason = args["reason"]
-        if func.show_spinner:
-            with st.spinner(f"{reason}[{func.name}]"):
-                func_result = func(args)
+        func = self.functions.get(call["name"])
+        if func is not None and not func.show_spinner:
+            return None
+        uses_data = func is not None and func.uses_data
+        previous = self.data_tail if uses_data else None
+        context = get_script_run_ctx()
+
+        if func is not None and func.is_async:
+            async def run_async():
+                for thread in preparing:
+                    await asyncio.to_thread(thread.join)
+                if previous is not None:
+                    await asyncio.wrap_future(previous)
+                return await self._arun_call(call, context)
+
+            future = submit(run_async())
         else:
-            func_result = func(args)
-
-        text = "Thinking..."
-        if func.show_spinner:
-            text = f"{reason}[{func.name}]"
-        with st.spinner(text):
-            self.internal_messages.append({"role": "function", "name": func.name, "content": func_result})
-            message = openai.ChatCompletion.create(
-                model=self.model_name,
-                messages=self.internal_messages,
-                # + [{"role": "system", "content": "Only proceed if this achieved the desired result and no another function need to be called"}],
-                functions=list(map(lambda x: x.to_dict(), self.functions.values())),
-                function_call="auto"
-            )
-            message = message["choices"][0]["message"]
-        return message
+            def run():
+                # The functions may need the session state of the script
+                add_script_run_ctx(threading.current_thread(), context)
+                for thread in preparing:
+                    thread.join()
+                if previous is not None:
+                    wait([previous])
+                return self._run_call(call)
+
+            future = self.executor.submit(run)
+        if uses_data:
+            self.data_tail = future
+        return future
+
+    def call_functions(self, message: dict):
+        """
+        Makes all the calls in a message from the LLM and adds their results to the internal messages.
+        Independent calls run concurrently, calls already started while the message was streaming are not repeated.
+        Each result is checkpointed in the turn as soon as its call finishes, so calls that finished before a failure
+        are not made again. Calls still running at the time of a failure are picked up when the turn resumes.
+        :param message: the message with the calls
+        """
+        if message.get("tool_calls"):
+            calls = [self._unpack(call) for call in message["tool_calls"]]
+        else:
+            calls = [self._unpack(message["function_call"])]
+        results = self.turn["results"]
+        futures = {}
+        for call in calls:
+            if call["key"] in results:
+                self.pending.pop(call["key"], None)
+                continue
+            if call["key"] in self.pending:
+                futures[call["key"]] = self.pending.pop(call["key"])
+            else:
+                futures[call["key"]] = self._dispatch(call)
+        for key, future in futures.items():
+            if future is not None:
+                future.add_done_callback(functools.partial(self._checkpoint, results, key))
+
+        status = st.empty()
+        try:
+            self._show_status(status, calls, results)
+            for call in calls:
+                if call["key"] in futures and futures[call["key"]] is None:
+                    func = self.functions.get(call["name"])
+                    if func is not None and func.uses_data and self.data_tail is not None:
+                        wait([self.data_tail])
+                    results[call["key"]] = self._run_call(call)
+            running = {future: call for call in calls if (future := futures.get(call["key"])) is not None}
+            for future in as_completed(running):
+                results[running[future]["key"]] = future.result()
+                self._show_status(status, calls, results)
+        except BaseException:
+            # The calls still running are kept, so that resuming the turn waits for them instead of repeating them
+            self.pending.update({key: future for key, future in futures.items()
+                                 if future is not None and key not in results})
+            raise
+        status.empty()
+        self.data_tail = None
+
+        if self.tool_calls:
+            # The results must follow the message that made the calls
+            self.internal_messages.append(message)
+            for call in calls:
+                self.internal_messages.append({"role": "tool", "tool_call_id": call["id"], "content": results[call["key"]]})
+        else:
+            call = calls[0]
+            self.internal_messages.append({"role": "function", "name": call["name"], "content": results[call["key"]]})
+        self.turn["message"] = None
+        self.turn["results"] = {}
+
+    @staticmethod
+    def _checkpoint(results: dict, key: str, future: Future):
+        """
+        Records the result of a finished call in the checkpoint of its turn.
+        :param results: the results of the turn, by call key
+        :param key: the key of the call
+        :param future: the finished call
+        """
+        if not future.cancelled() and future.exception() is None:
+            results[key] = future.result()
+
+    def _show_status(self, status, calls: list, results: dict):
+        """
+        Shows the progress of each call that shows a spinner.
+        :param status: the streamlit element to show the progress in
+        :param calls: the unpacked calls
+        :param results: the results of the finished calls, by call key
+        """
+        lines = []
+        for call in calls:
+            func = self.functions.get(call["name"])
+            if func is None or not func.show_spinner:
+                continue
+            icon = "✅" if call["key"] in results else "⏳"
+            lines.append(f"{icon} {call['reason']}[{call['name']}]")
+        if lines:
+            status.markdown("  \n".join(lines))
 
     def reset_to_last(self):
         """
@@ -129,6 +467,7 @@ class Conversator:
         """
         st.session_state["messages"] = st.session_state["messages"][:self.last_msg_len]
         self.internal_messages = self.internal_messages[:self.last_internal_msg_len]
+        self.turn = None
 
     def reset(self):
         """
@@ -136,3 +475,4 @@ class Conversator:
         """
         st.session_state["messages"] = []
         self.internal_messages = [{"role": "system", "content": _starter_prompt}]
+        self.turn = None
@@ -0,0 +1,46 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+import yaml
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get the event loop shared by all sessions for async tools, starting it on first use.
+    The loop runs forever in a background thread. Sync functions called from it run on its default executor,
+    a thread pool sized in the config.
+    :return: the event loop
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["async_tools"]
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=config["threads"],
+                                                         thread_name_prefix="async-tools"))
+            thread = threading.Thread(target=loop.run_forever, name="async-tools-loop", daemon=True)
+            thread.start()
+            _loop = loop
+    return _loop
+
+
+def submit(coroutine) -> Future:
+    """
+    Starts a coroutine on the shared event loop.
+    :param coroutine: the coroutine
+    :return: a future for its result, which can be waited on from any thread
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_event_loop())
+
+
+def run_sync(coroutine):
+    """
+    Runs a coroutine on the shared event loop and waits for its result.
+    Must not be called from the loop itself, use await there instead.
+    :param coroutine: the coroutine
+    :return: the result of the coroutine
+    """
+    return submit(coroutine).result()
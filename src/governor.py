@@ -0,0 +1,193 @@
+import json
+import uuid
+import threading
+import traceback
+import streamlit as st
+import yaml
+from src.context import get_token_counter
+from src.llm import get_llm_client
+
+# Parallel calls of a session store their pages at the same time
+_store_lock = threading.Lock()
+
+
+def to_json(result) -> str:
+    """
+    Serializes the result of a function compactly, without the whitespace that would cost tokens.
+    Values JSON does not support, like timestamps, are converted to strings.
+    :param result: the result
+    :return: the result as a JSON string
+    """
+    return json.dumps(result, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def _largest_text(result) -> tuple[str, str | None]:
+    """
+    Finds the text to cut an oversized result down by.
+    That is the result itself if it is a string, its longest string value if it is an object,
+    or otherwise the whole result as JSON.
+    :param result: the result
+    :return: the text, and the key it is under, None if it is the whole result
+    """
+    if isinstance(result, str):
+        return result, None
+    if isinstance(result, dict):
+        texts = [(len(value), key) for key, value in result.items() if isinstance(value, str)]
+        if texts:
+            key = max(texts)[1]
+            return result[key], key
+    return to_json(result), None
+
+
+def _store(handle: str, function_name: str, pages: list[str], keep: int):
+    """
+    Stores the pages of a result in the session, so that the LLM can ask for them later.
+    Only the most recent results are kept.
+    :param handle: the continuation handle of the result
+    :param function_name: the name of the function the result came from
+    :param pages: the pages
+    :param keep: the number of results to keep pages for
+    """
+    with _store_lock:
+        if "continuations" not in st.session_state:
+            st.session_state["continuations"] = {}
+        continuations = st.session_state["continuations"]
+        continuations[handle] = {"function": function_name, "pages": pages}
+        while len(continuations) > keep:
+            del continuations[next(iter(continuations))]
+
+
+def get_page(handle: str, page: int) -> dict:
+    """
+    Get a page of an oversized result.
+    :param handle: the continuation handle of the result
+    :param page: the number of the page, starting from 1
+    :return: the page with its position, or an error
+    """
+    with _store_lock:
+        continuations = st.session_state["continuations"] if "continuations" in st.session_state else {}
+        pages = continuations[handle]["pages"] if handle in continuations else None
+    if pages is None:
+        return {"error": f"There is no result with the continuation '{handle}'. It may have expired, "
+                         f"call the original function again."}
+    if not 1 <= page <= len(pages):
+        return {"error": f"The result only has pages 1 to {len(pages)}."}
+    output = {"partial_result": pages[page - 1], "page": page, "pages": len(pages)}
+    if page < len(pages):
+        output["note"] = f"Call read_more with continuation '{handle}' and page {page + 1} for the next part."
+    return output
+
+
+def _summarize(text: str, model: str, max_tokens: int) -> str:
+    """
+    Summarizes the start of a long text with the LLM.
+    :param text: the text
+    :param model: the model to use
+    :param max_tokens: the number of tokens from the start of the text to summarize
+    :return: the summary
+    """
+    head = get_token_counter().split_text(text, max_tokens)[0]
+    response = get_llm_client().complete(
+        "governor",
+        model=model,
+        messages=[
+            {"role": "system", "content": "Summarize the following function result. "
+                                          "Keep all names, numbers, dates and ids that may be needed later."},
+            {"role": "user", "content": head},
+        ],
+    )
+    return response["content"]
+
+
+def govern(function_name: str, result) -> str:
+    """
+    Serializes the result of a function, keeping it within the token budget of the function.
+    Results over the budget are cut down according to the mode configured for the function:
+    'paginate' returns the first page and a continuation handle to ask for the rest with read_more,
+    'summarize' returns a summary and a continuation handle to the full result,
+    and 'truncate' returns the first page only.
+    Each function has its own budget, or the default one, and no budget can be over the global maximum.
+    The longest text in the result is cut down first, the rest of the result kept as it is. If the rest alone
+    is too large for that to fit, the whole result is cut down as JSON instead.
+    :param function_name: the name of the function
+    :param result: the result of the function
+    :return: the result as a compact JSON string, cut down to the budget if needed
+    """
+    text = to_json(result)
+    config = yaml.safe_load(open("config.yaml", "r"))["governor"]
+    if not config["enabled"] or function_name in config["exclude"]:
+        return text
+    settings = config["functions"].get(function_name, {})
+    budget = min(settings.get("tokens", config["default_tokens"]), config["max_tokens"])
+    mode = settings.get("mode", config["default_mode"])
+    counter = get_token_counter()
+    tokens = counter.count_text(text)
+    if tokens <= budget:
+        return text
+
+    body, key = _largest_text(result)
+    output = _cut_down(function_name, result, body, key, tokens, budget, mode, config)
+    if key is not None and counter.count_text(output) > budget:
+        output = _cut_down(function_name, result, text, None, tokens, budget, mode, config)
+    print(f"\nResult of {function_name} cut down from {tokens} tokens to fit its budget of {budget} tokens ({mode})")
+    return output
+
+
+def _cut_down(function_name: str, result, body: str, key: str | None, tokens: int, budget: int, mode: str,
+              config: dict) -> str:
+    """
+    Cuts down a text in the result of a function to fit the budget of the function.
+    :param function_name: the name of the function
+    :param result: the result of the function
+    :param body: the text to cut down
+    :param key: the key of the text in the result, None if it is the whole result as JSON
+    :param tokens: the tokens of the whole result
+    :param budget: the token budget of the function
+    :param mode: how to cut the text down, 'paginate', 'summarize' or 'truncate'
+    :param config: the governor config
+    :return: the result as a compact JSON string, with the text cut down
+    """
+    counter = get_token_counter()
+    handle = f"{function_name}-{uuid.uuid4().hex[:8]}"
+    summary = None
+    if mode == "summarize":
+        try:
+            summary = _summarize(body, config["summarize_model"], config["summarize_tokens"])
+        except Exception:
+            traceback.print_exc()
+            mode = "paginate"
+
+    def build(pages: list[str]) -> str:
+        field, content = "partial_result", pages[0]
+        details = {"page": 1, "pages": len(pages), "total_tokens": tokens}
+        if summary is not None:
+            field, content = "summary", summary
+            details = {"summary_of_tokens": tokens, "pages": len(pages)}
+        if mode == "truncate":
+            details["note"] = f"The result was truncated from {tokens} tokens, the rest is not available."
+        else:
+            details["continuation"] = handle
+            if summary is not None:
+                details["note"] = f"The result was too long to return whole, this is a summary of it. " \
+                                  f"Call read_more with continuation '{handle}' and page 1 to read it from the start."
+            else:
+                details["note"] = f"The result was too long to return whole, this is page 1 of {len(pages)}. " \
+                                  f"Call read_more with continuation '{handle}' and page 2 to read more of it."
+        if key is None:
+            return to_json({field: content, **details})
+        return to_json({**result, key: content, "result_pages": details})
+
+    # What the rest of the result and the page details take up, the cut down text gets whatever is left
+    overhead = tokens - counter.count_text(body) + config["page_overhead_tokens"]
+    page_tokens = max(budget - overhead, config["page_overhead_tokens"])
+    for _ in range(3):
+        pages = counter.split_text(body, page_tokens)
+        output = build(pages)
+        excess = counter.count_text(output) - budget
+        # Escaping the page as a JSON string can add tokens, if so the pages are made smaller
+        if excess <= 0 or summary is not None or page_tokens <= config["page_overhead_tokens"]:
+            break
+        page_tokens = max(page_tokens - excess, config["page_overhead_tokens"])
+    if mode != "truncate":
+        _store(handle, function_name, pages, config["keep_results"])
+    return output
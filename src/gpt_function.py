@@ -1,14 +1,21 @@
-import json
+import asyncio
 import inspect
 import docstring_parser as docparser
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+import threading
 import traceback
+from src.arguments import compile_annotation, compile_validator, passthrough
+from src.event_loop import run_sync
+from src.governor import govern, to_json
+from data.capture import capture_tables
 
 
 class GPTFunction:
     """
     A wrapper for other functions to become GPT functions,
     which can be passed to an LLM for use.
+    Both sync and async functions can be wrapped, and either can be called with or without awaiting.
     """
 
     def __init__(self,
@@ -17,7 +24,8 @@ class GPTFunction:
                  properties: dict,
                  required: list = None,
                  func_callable: callable = None,
-                 show_spinner: bool = True
+                 show_spinner: bool = True,
+                 validate: callable = None
                  ):
 
         if required is None:
@@ -27,7 +35,17 @@ class GPTFunction:
         self.properties = properties
         self.required = required
         self.func_callable = func_callable
+        self.is_async = inspect.iscoroutinefunction(func_callable)
         self.show_spinner = show_spinner
+        # Whether the function reads or writes the data store. Such calls run one at a time, in the order they were made
+        self.uses_data = False
+        # Checks and converts the arguments from the LLM, compiled once from the signature of the function.
+        # Without one, the arguments are only checked against the names of the parameters
+        if validate is None:
+            validate = compile_validator({name: passthrough for name in properties}, list(required))
+        self.validate = validate
+        # Work to start as soon as an argument is known, by argument name
+        self.preparers = {}
 
         self.properties["reason"] = {
             "type": "string",
@@ -50,48 +68,125 @@ class GPTFunction:
             }
         }
 
+    def add_preparer(self, argument: str, preparer: callable):
+        """
+        Registers work that can be started as soon as an argument is known,
+        while the rest of the arguments are still being generated.
+        :param argument: the name of the argument
+        :param preparer: a function taking the value of the argument
+        """
+        self.preparers[argument] = preparer
+
+    def prepare(self, argument: str, value) -> threading.Thread | None:
+        """
+        Starts the preparatory work for an argument in a background thread.
+        Preparation is only an optimization, so failures are printed and otherwise ignored.
+        :param argument: the name of the argument
+        :param value: the value of the argument
+        :return: the thread doing the work, or None if there is nothing to prepare for the argument
+        """
+        preparer = self.preparers.get(argument)
+        if preparer is None:
+            return None
+
+        def run():
+            try:
+                preparer(value)
+            except Exception:
+                traceback.print_exc()
+
+        thread = threading.Thread(target=run, daemon=True)
+        # The work may need the session state of the script that started it
+        add_script_run_ctx(thread)
+        thread.start()
+        return thread
+
+    def _validated(self, args: dict) -> tuple[dict, str | None]:
+        """
+        Converts the parameters to the correct types.
+        :param args: the parameters from the LLM
+        :return: the converted parameters, and the errors as a JSON string if any of them are missing or invalid
+        """
+        args = dict(args)
+        args.pop("reason", None)
+        args, errors = self.validate(args)
+        if errors:
+            return args, to_json({
+                "error": f"The arguments are not valid, so '{self.name}' was not called. Fix them and call it again.",
+                "invalid_arguments": errors,
+            })
+        return args, None
+
+    def _finish(self, args: dict, result) -> str:
+        """
+        Stores a large table in the result as new data, leaving a handle to it in its place, and serializes the result
+        within the token budget of the function.
+        Needs the session state, so it has to run on a thread with the script run context.
+        :param args: the parameters the function was called with
+        :param result: the output of the function
+        :return: the output as a compact JSON string
+        """
+        return govern(self.name, capture_tables(self.name, args, result))
+
     def __call__(self, args: dict) -> str:
         """
         Calls the inner function with the given parameters
-        The parameters are converted to the correct types
+        The parameters are converted to the correct types first.
+        If any of them are missing or invalid, the function is not called and the errors are returned instead.
+        An async function is run on the shared event loop, and this waits for it.
+        A large table in the output is stored as new data and replaced with a handle to it,
+        and an output over the token budget of the function is cut down to a page or a summary.
         :param args: the parameters to pass to the function
-        :return: the output of the function as a JSON string
+        :return: the output of the function as a compact JSON string
         """
+        args, error = self._validated(args)
+        if error is not None:
+            return error
 
-        args.pop("reason")
-        # Covert to correct types
-        for property in self.properties:
-            if property in args:
-                if self.properties[property]["type"] == "integer":
-                    args[property] = int(args[property])
-                elif self.properties[property]["type"] == "array":
-                    args[property] = args[property]
-                    if self.properties[property]["items"]["type"] == "integer":
-                        args[property] = list(map(int, args[property]))
-                    elif self.properties[property]["items"]["type"] == "number":
-                        args[property] = list(map(float, args[property]))
-                elif self.properties[property]["type"] == "number":
-                    args[property] = float(args[property])
-
-        result = self.func_callable(**args)
-        return json.dumps(result, indent=4)
+        if not self.is_async:
+            result = self.func_callable(**args)
+        elif self.show_spinner:
+            result = run_sync(self.func_callable(**args))
+        else:
+            # Agents draw on the page, which has to be done from the script thread,
+            # so they get an event loop of their own on it instead
+            result = asyncio.run(self.func_callable(**args))
+        return self._finish(args, result)
+
+    async def acall(self, args: dict, context=None, raw: bool = False) -> str:
+        """
+        Calls the inner function with the given parameters, without blocking the event loop.
+        An async function is awaited, a sync one is run on the thread pool of the event loop.
+        :param args: the parameters to pass to the function
+        :param context: the script run context to give the thread running a sync function,
+        for functions that use the session state, optional
+        :param raw: whether to return the output whole, without capturing tables or cutting it down to the budget.
+        For agents that combine many outputs themselves before anything goes back to the LLM, optional
+        :return: the output of the function as a compact JSON string
+        """
+        args, error = self._validated(args)
+        if error is not None:
+            return error
+
+        result = await self.func_callable(**args) if self.is_async else None
+
+        def run():
+            if context is not None:
+                add_script_run_ctx(threading.current_thread(), context)
+            output = result if self.is_async else self.func_callable(**args)
+            return to_json(output) if raw else self._finish(args, output)
+
+        return await asyncio.get_running_loop().run_in_executor(None, run)
 
 
 def gpt_function(func) -> GPTFunction:
     """
     A decorator to convert a function to a GPT function
     Parses the description and parameters from the docstring as well as their types
-    from the signature.
+    from the signature. The validation of the arguments is compiled from the types here, once.
     :param func: the function to convert
     :return: the wrapped GPT function
     """
-    mapping = {
-        "str": "string",
-        "int": "integer",
-        "float": "number",
-        "list": "array",
-    }
-
     try:
         docstring = docparser.parse(func.__doc__)
         signature = inspect.signature(func)
@@ -140,19 +235,16 @@ def gpt_function(func) -> GPTFunction:
 
         properties = {}
         required = []
+        coercers = {}
         for index, param in enumerate(parameters):
-            param_type = mapping.get(parameters[param].annotation.__name__, "string")
+            schema, coercers[param] = compile_annotation(parameters[param].annotation)
             properties[param] = {
-                "type": param_type,
+                **schema,
                 "description": docstring.params[index].description.replace("\n", " ")
             }
-            # Extract the inner type of the array
-            if param_type == "array":
-                properties[param]["items"] = {
-                    "type": mapping.get(parameters[param].annotation.__args__[0].__name__, "string")
-                }
             if parameters[param].default is inspect.Parameter.empty:
                 required.append(param)
+        validate = compile_validator(coercers, required)
 
     except Exception:
         st.error(f"Error parsing the '{func.__name__}' function")
@@ -166,6 +258,7 @@ def gpt_function(func) -> GPTFunction:
         properties=properties,
         required=required,
         func_callable=func,
+        validate=validate,
     )
 
 
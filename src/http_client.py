@@ -0,0 +1,137 @@
+import time
+import random
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import yaml
+
+
+def _retry(attempts: int, backoff_seconds: float, max_backoff_seconds: float, statuses: list[int]) -> Retry:
+    """
+    Creates the retry policy for requests to external APIs.
+    Connection errors and the given statuses are retried, with a delay that doubles with every attempt
+    up to a maximum, with jitter so that concurrent sessions spread out. A Retry-After header is respected.
+    Read timeouts are not retried, a server that is stuck would otherwise hold the call for every attempt.
+    The last response is returned rather than raised, so that tools can report the status themselves.
+    :param attempts: the number of retries
+    :param backoff_seconds: the delay before the first retry
+    :param max_backoff_seconds: the maximum delay
+    :param statuses: the statuses to retry
+    :return: the retry policy
+    """
+    class JitteredRetry(Retry):
+        def get_backoff_time(self) -> float:
+            return min(max_backoff_seconds, super().get_backoff_time()) * random.uniform(0.5, 1.0)
+
+    return JitteredRetry(
+        total=attempts,
+        read=0,
+        backoff_factor=backoff_seconds,
+        status_forcelist=statuses,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+
+class HTTPClient:
+    """
+    The HTTP client shared by every tool that calls an external API.
+    Keeps a pool of keep-alive connections per host, so that calls after the first skip the TCP and TLS handshakes,
+    sets default timeouts, retries rate limits and server errors, and records the latency of every host.
+    """
+
+    def __init__(self, timeout_seconds: float = 20, connect_timeout_seconds: float = 5, pool_hosts: int = 16,
+                 pool_size: int = 8, retries: int = 3, backoff_seconds: float = 0.5, max_backoff_seconds: float = 8,
+                 retry_statuses: list[int] = None, latency_window: int = 200):
+        self.timeout = (connect_timeout_seconds, timeout_seconds)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_size,
+            max_retries=_retry(retries, backoff_seconds, max_backoff_seconds,
+                               retry_statuses or [429, 500, 502, 503, 504]),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.latency_window = latency_window
+        # host -> {"requests": int, "errors": int, "latencies": deque of seconds}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _record(self, url: str, seconds: float, failed: bool):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = {"requests": 0, "errors": 0, "latencies": deque(maxlen=self.latency_window)}
+            metrics = self.hosts[host]
+            metrics["requests"] += 1
+            metrics["errors"] += failed
+            metrics["latencies"].append(seconds)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Makes a request, with the default timeouts unless others are given.
+        :param method: the HTTP method
+        :param url: the url
+        :param kwargs: the other arguments, as for requests.request
+        :return: the response, after any retries
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._record(url, time.perf_counter() - start, True)
+            raise
+        self._record(url, time.perf_counter() - start, response.status_code >= 400)
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        Makes a GET request, with the default timeouts unless others are given.
+        :param url: the url
+        :param kwargs: the other arguments, as for requests.get
+        :return: the response, after any retries
+        """
+        return self.request("GET", url, **kwargs)
+
+    def stats(self) -> dict:
+        """
+        Get the latency of every host called, over its most recent requests.
+        :return: the number of requests and errors, and the mean, median, 95th percentile and maximum latency
+        in milliseconds, per host
+        """
+        with self.lock:
+            hosts = {host: (metrics["requests"], metrics["errors"], sorted(metrics["latencies"]))
+                     for host, metrics in self.hosts.items()}
+        stats = {}
+        for host, (count, errors, latencies) in hosts.items():
+            stats[host] = {
+                "requests": count,
+                "errors": errors,
+                "mean_ms": round(1000 * sum(latencies) / len(latencies), 1),
+                "p50_ms": round(1000 * latencies[len(latencies) // 2], 1),
+                "p95_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+                "max_ms": round(1000 * latencies[-1], 1),
+            }
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client() -> HTTPClient:
+    """
+    Get the process-wide HTTP client, creating it on first use.
+    :return: the HTTP client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["http"]
+            _client = HTTPClient(**config)
+    return _client
@@ -0,0 +1,330 @@
+import json
+import time
+import asyncio
+import threading
+import weakref
+import requests
+import openai
+import yaml
+from src.llm_cache import get_llm_cache, cache_enabled, request_key
+
+
+class _SharedSession(requests.Session):
+    """
+    A requests session shared by every thread making LLM requests.
+    The openai library closes its session every few minutes, which would drop the connections of every thread,
+    so closing is left to the process exiting.
+    """
+
+    def close(self):
+        pass
+
+
+class OpenAIBackend:
+    """
+    Sends requests to the OpenAI API.
+    Synchronous requests from all threads share a pool of keep-alive connections,
+    asynchronous requests share an aiohttp session per event loop.
+    """
+
+    def __init__(self, api_key: str, timeout_seconds: float = 120, pool_size: int = 16):
+        self.api_key = api_key
+        self.timeout = timeout_seconds
+        self.pool_size = pool_size
+        session = _SharedSession()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+        session.mount("https://", adapter)
+        openai.requestssession = session
+        self.aiosessions = weakref.WeakKeyDictionary()
+
+    def create(self, **request):
+        """
+        Makes a chat completion request.
+        :param request: the keyword arguments of the request
+        :return: the response, or an iterator over its chunks if streamed
+        """
+        return openai.ChatCompletion.create(api_key=self.api_key, request_timeout=self.timeout, **request)
+
+    async def acreate(self, **request):
+        """
+        Makes a chat completion request asynchronously.
+        :param request: the keyword arguments of the request
+        :return: the response, or an async iterator over its chunks if streamed
+        """
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if loop not in self.aiosessions:
+            self.aiosessions[loop] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        openai.aiosession.set(self.aiosessions[loop])
+        return await openai.ChatCompletion.acreate(api_key=self.api_key, request_timeout=self.timeout, **request)
+
+
+def _mock_value(schema: dict):
+    """
+    Get a placeholder value for a function argument.
+    :param schema: the schema of the argument
+    :return: the value
+    """
+    values = {"string": "mock", "integer": 1, "number": 1.0, "boolean": False, "array": [], "object": {}}
+    if "enum" in schema:
+        return schema["enum"][0]
+    return values.get(schema.get("type"), "mock")
+
+
+class MockBackend:
+    """
+    A deterministic local stand-in for the OpenAI API, to run and load test the whole app offline.
+    The same request always gets the same response, after a configurable latency and generation speed.
+    If the last message, apart from system messages, is from the user and names one of the functions,
+    the function is called with placeholder arguments, otherwise a short text response is returned.
+    """
+
+    def __init__(self, latency_seconds: float = 0.2, tokens_per_second: float = 50):
+        self.latency = latency_seconds
+        self.tokens_per_second = tokens_per_second
+
+    def _respond(self, request: dict) -> tuple[dict, str]:
+        """
+        Builds the response message to a request.
+        :param request: the keyword arguments of the request
+        :return: the message and the finish reason
+        """
+        digest = request_key(request)[:8]
+        conversation = [message for message in request["messages"] if message["role"] != "system"]
+        last = (conversation or request["messages"])[-1]
+        if "tools" in request:
+            schemas = [tool["function"] for tool in request["tools"]]
+            allowed = request.get("tool_choice", "auto") != "none"
+        else:
+            schemas = request.get("functions", [])
+            allowed = request.get("function_call", "auto") != "none"
+
+        if allowed and last["role"] == "user":
+            for schema in schemas:
+                if schema["name"] not in (last.get("content") or ""):
+                    continue
+                properties = schema["parameters"]["properties"]
+                arguments = json.dumps({name: _mock_value(prop) for name, prop in properties.items()})
+                call = {"name": schema["name"], "arguments": arguments}
+                if "tools" in request:
+                    message = {"role": "assistant", "content": None,
+                               "tool_calls": [{"id": f"call_{digest}", "type": "function", "function": call}]}
+                    return message, "tool_calls"
+                return {"role": "assistant", "content": None, "function_call": call}, "function_call"
+
+        length = len(last.get("content") or "")
+        content = f"Mock response {digest} to a {last['role']} message of {length} characters."
+        return {"role": "assistant", "content": content}, "stop"
+
+    def _chunks(self, message: dict, finish_reason: str) -> list[dict]:
+        """
+        Splits a message into the chunks it would be streamed as.
+        :param message: the message
+        :param finish_reason: the finish reason of the message
+        :return: the chunks
+        """
+        chunks = [{"role": "assistant"}]
+        if message.get("content"):
+            chunks += [{"content": word} for word in message["content"].split(" ")]
+            for index in range(1, len(chunks) - 1):
+                chunks[index]["content"] += " "
+        for index, call in enumerate(message.get("tool_calls") or []):
+            chunks.append({"tool_calls": [{"index": index, "id": call["id"], "type": "function",
+                                           "function": {"name": call["function"]["name"], "arguments": ""}}]})
+            chunks.append({"tool_calls": [{"index": index, "function": {"arguments": call["function"]["arguments"]}}]})
+        if message.get("function_call"):
+            chunks.append({"function_call": {"name": message["function_call"]["name"], "arguments": ""}})
+            chunks.append({"function_call": {"arguments": message["function_call"]["arguments"]}})
+        chunks = [{"choices": [{"index": 0, "delta": delta, "finish_reason": None}]} for delta in chunks]
+        chunks.append({"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+        return chunks
+
+    def create(self, **request):
+        """
+        Makes a chat completion request.
+        :param request: the keyword arguments of the request
+        :return: the response, or an iterator over its chunks if streamed
+        """
+        message, finish_reason = self._respond(request)
+        time.sleep(self.latency)
+        if not request.get("stream"):
+            return {"choices": [{"index": 0, "message": message, "finish_reason": finish_reason}]}
+
+        def stream():
+            for chunk in self._chunks(message, finish_reason):
+                time.sleep(1 / self.tokens_per_second)
+                yield chunk
+        return stream()
+
+    async def acreate(self, **request):
+        """
+        Makes a chat completion request asynchronously.
+        :param request: the keyword arguments of the request
+        :return: the response, or an async iterator over its chunks if streamed
+        """
+        message, finish_reason = self._respond(request)
+        await asyncio.sleep(self.latency)
+        if not request.get("stream"):
+            return {"choices": [{"index": 0, "message": message, "finish_reason": finish_reason}]}
+
+        async def stream():
+            for chunk in self._chunks(message, finish_reason):
+                await asyncio.sleep(1 / self.tokens_per_second)
+                yield chunk
+        return stream()
+
+
+class _Stream:
+    """
+    An iterator over the chunks of a streamed response that holds a slot of the concurrency limit.
+    The slot is given back once the stream is read to the end, fails or is closed,
+    so a consumer that stops reading early must close it, e.g. with contextlib.closing.
+    """
+
+    def __init__(self, response, semaphore: threading.BoundedSemaphore):
+        self.response = iter(response)
+        self.semaphore = semaphore
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        try:
+            return next(self.response)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Stops reading the stream and gives back its slot.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        close = getattr(self.response, "close", None)
+        try:
+            if close is not None:
+                close()
+        finally:
+            self.semaphore.release()
+
+
+class LLMClient:
+    """
+    The single entry point for LLM requests.
+    Limits the number of concurrent requests per model, serves repeated requests from the response cache,
+    and sends the rest to a backend, either the OpenAI API or the local mock.
+    """
+
+    def __init__(self, backend, concurrency: dict = None, default_concurrency: int = 8):
+        self.backend = backend
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.semaphores = {}
+        self.async_semaphores = {}
+        self.lock = threading.Lock()
+
+    def _semaphore(self, model: str) -> threading.BoundedSemaphore:
+        with self.lock:
+            if model not in self.semaphores:
+                self.semaphores[model] = threading.BoundedSemaphore(self.concurrency.get(model, self.default_concurrency))
+            return self.semaphores[model]
+
+    def _async_semaphore(self, model: str) -> asyncio.Semaphore:
+        # Async requests run on a single event loop, so its semaphores are separate from the thread ones
+        with self.lock:
+            if model not in self.async_semaphores:
+                self.async_semaphores[model] = asyncio.Semaphore(self.concurrency.get(model, self.default_concurrency))
+            return self.async_semaphores[model]
+
+    def create(self, **request):
+        """
+        Makes a chat completion request, waiting for a free slot for the model first.
+        A streamed request holds its slot until the stream is read to the end or closed.
+        :param request: the keyword arguments of the request, as for openai.ChatCompletion.create
+        :return: the response, or an iterator over its chunks if streamed
+        """
+        semaphore = self._semaphore(request["model"])
+        semaphore.acquire()
+        try:
+            response = self.backend.create(**request)
+        except BaseException:
+            semaphore.release()
+            raise
+        if not request.get("stream"):
+            semaphore.release()
+            return response
+
+        return _Stream(response, semaphore)
+
+    def complete(self, site: str, cache: bool = True, **request) -> dict:
+        """
+        Gets the response message to a request, from the cache if the same request was made before.
+        :param site: the call site making the request, used for the cache hit rate and for opting out of the cache
+        :param cache: whether to use the cache for this request
+        :param request: the keyword arguments of the request, as for openai.ChatCompletion.create
+        :return: the response message
+        """
+        cache = cache and cache_enabled(site)
+        if cache:
+            message = get_llm_cache().get(request, site)
+            if message is not None:
+                return message
+        message = self.create(**request)["choices"][0]["message"]
+        if cache:
+            get_llm_cache().put(request, message)
+        return message
+
+    async def acreate(self, **request):
+        """
+        Makes a chat completion request asynchronously, waiting for a free slot for the model first.
+        :param request: the keyword arguments of the request, as for openai.ChatCompletion.create
+        :return: the response, a streamed request is read whole and returned as a list of chunks
+        """
+        async with self._async_semaphore(request["model"]):
+            response = await self.backend.acreate(**request)
+            if request.get("stream"):
+                return [chunk async for chunk in response]
+            return response
+
+    async def acomplete(self, site: str, cache: bool = True, **request) -> dict:
+        """
+        Gets the response message to a request asynchronously, from the cache if the same request was made before.
+        :param site: the call site making the request, used for the cache hit rate and for opting out of the cache
+        :param cache: whether to use the cache for this request
+        :param request: the keyword arguments of the request, as for openai.ChatCompletion.create
+        :return: the response message
+        """
+        cache = cache and cache_enabled(site)
+        if cache:
+            message = get_llm_cache().get(request, site)
+            if message is not None:
+                return message
+        message = (await self.acreate(**request))["choices"][0]["message"]
+        if cache:
+            get_llm_cache().put(request, message)
+        return message
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """
+    Get the process-wide LLM client, creating it on first use.
+    :return: the LLM client
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["llm"]
+            if config["backend"] == "mock":
+                backend = MockBackend(**config["mock"])
+            else:
+                from secret import keys
+                backend = OpenAIBackend(keys.openai_key, config["timeout_seconds"], config["pool_size"])
+            _client = LLMClient(backend, config["concurrency"], config["default_concurrency"])
+    return _client
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import yaml
+
+# Kept with the app rather than in the shared temp directory, so that only this deployment can read or write it
+_DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "llm-cache.sqlite")
+
+
+def request_key(request: dict) -> str:
+    """
+    Computes the canonical hash of a completion request.
+    Covers the model, the messages, the function schemas and every other option that changes the response.
+    Whether the response is streamed does not change it, so that is left out.
+    :param request: the keyword arguments of the request
+    :return: the hash
+    """
+    canonical = {name: value for name, value in request.items() if name != "stream"}
+    text = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    A cache of LLM responses kept in a local SQLite file, shared by all sessions and kept across restarts.
+    Entries expire after a time to live, and the least recently used entries are evicted
+    when the file grows over its size limit.
+    Hits and misses are counted per call site.
+    """
+
+    def __init__(self, path: str = None, max_mb: float = 256, ttl_hours: float = 24 * 7):
+        self.path = path or _DEFAULT_PATH
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.ttl = ttl_hours * 60 * 60
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        # site -> {"hits": int, "misses": int}
+        self.counts = {}
+
+    def get(self, request: dict, site: str = "default") -> dict | None:
+        """
+        Looks up the response to a request.
+        :param request: the keyword arguments of the request
+        :param site: the call site making the request, used for the hit rate
+        :return: the cached response message, or None on a miss
+        """
+        key = request_key(request)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT response, size, created FROM entries WHERE key = ?",
+                                          (key,)).fetchone()
+            if row is not None and now - row[2] > self.ttl:
+                self._delete(key, row[1])
+                row = None
+            counts = self.counts.setdefault(site, {"hits": 0, "misses": 0})
+            if row is None:
+                counts["misses"] += 1
+                return None
+            counts["hits"] += 1
+            self.connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        print(f"\nLLM cache hit for {site}, {counts['hits']}/{counts['hits'] + counts['misses']} hits at this site")
+        return json.loads(row[0])
+
+    def put(self, request: dict, response: dict):
+        """
+        Stores the response to a request, evicting the least recently used entries if the cache is over its size.
+        :param request: the keyword arguments of the request
+        :param response: the response message
+        """
+        key = request_key(request)
+        text = json.dumps(response, ensure_ascii=False)
+        size = len(text.encode("utf-8"))
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                    (key, text, size, now, now))
+            self.size += size
+            self._evict(now)
+            self.connection.commit()
+
+    def _delete(self, key: str, size: int):
+        self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.size -= size
+        self.connection.commit()
+
+    def _evict(self, now: float):
+        """
+        Removes the expired entries, then the least recently used ones until the cache fits in its size.
+        """
+        self.connection.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while self.size > self.max_bytes:
+            rows = self.connection.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self.size <= self.max_bytes:
+                    break
+                self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.size -= size
+
+    def stats(self) -> dict:
+        """
+        Get the hit rate of the cache, overall and per call site.
+        :return: the hits, misses and hit rate per call site and in total, and the size of the cache
+        """
+        with self.lock:
+            sites = {site: dict(counts) for site, counts in self.counts.items()}
+        hits = sum(counts["hits"] for counts in sites.values())
+        misses = sum(counts["misses"] for counts in sites.values())
+        for counts in sites.values():
+            total = counts["hits"] + counts["misses"]
+            counts["hit_rate"] = round(counts["hits"] / total, 3) if total else None
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+            "size_mb": round(self.size / (1024 * 1024), 3),
+            "sites": sites,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    """
+    Get the process-wide LLM response cache, creating it on first use.
+    :return: the cache
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            config = yaml.safe_load(open("config.yaml", "r"))["cache"]
+            _cache = LLMCache(
+                path=config["path"],
+                max_mb=config["max_mb"],
+                ttl_hours=config["ttl_hours"],
+            )
+    return _cache
+
+
+def cache_enabled(site: str) -> bool:
+    """
+    Checks if responses are cached for a call site.
+    :param site: the call site
+    :return: True if the cache is enabled and the site has not opted out in the config
+    """
+    config = yaml.safe_load(open("config.yaml", "r"))["cache"]
+    return config["enabled"] and site not in config["disabled_sites"]
+
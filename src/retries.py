@@ -0,0 +1,86 @@
+import time
+import random
+import openai
+import yaml
+
+
+class MalformedArguments(Exception):
+    """
+    Raised when the LLM returns a call with arguments that are not valid JSON.
+    """
+
+    def __init__(self, message: dict):
+        super().__init__("The arguments of a call are not valid JSON")
+        # The message with the malformed call, used if the retries run out
+        self.message = message
+
+
+class RetryPolicy:
+    """
+    How often, and how long after, a class of failures is retried.
+    The delay doubles with every attempt up to a maximum, with jitter so that concurrent sessions spread out.
+    """
+
+    def __init__(self, attempts: int = 1, backoff_seconds: float = 0, max_backoff_seconds: float = 0):
+        self.attempts = attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    def delay(self, attempt: int) -> float:
+        """
+        Get the time to wait before retrying.
+        :param attempt: the number of the attempt that failed, starting from 1
+        :return: the delay in seconds
+        """
+        delay = min(self.max_backoff_seconds, self.backoff_seconds * 2 ** (attempt - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+
+def classify(error: Exception) -> str:
+    """
+    Get the class of a failure, which decides how it is retried.
+    :param error: the error
+    :return: the failure class, 'rate_limit', 'timeout', 'malformed_arguments' or 'other'
+    """
+    if isinstance(error, openai.error.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, (openai.error.Timeout, openai.error.APIConnectionError,
+                          openai.error.ServiceUnavailableError, TimeoutError)):
+        return "timeout"
+    if isinstance(error, openai.error.APIError) and (error.http_status or 500) >= 500:
+        return "timeout"
+    if isinstance(error, MalformedArguments):
+        return "malformed_arguments"
+    return "other"
+
+
+def with_retries(func: callable, policies: dict):
+    """
+    Calls a function, retrying it on failure according to the policy for the class of the failure.
+    Each class of failure has its own count of attempts.
+    :param func: the function to call, without arguments
+    :param policies: the retry policy for each class of failure
+    :return: the result of the function
+    """
+    attempts = {}
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            failure = classify(e)
+            attempts[failure] = attempts.get(failure, 0) + 1
+            policy = policies[failure]
+            if attempts[failure] >= policy.attempts:
+                raise
+            delay = policy.delay(attempts[failure])
+            print(f"\n{failure} failure ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def get_retry_policies() -> dict:
+    """
+    Get the retry policies for each class of failure from the config.
+    :return: the retry policy for each class of failure
+    """
+    config = yaml.safe_load(open("config.yaml", "r"))["retries"]
+    return {failure: RetryPolicy(**policy) for failure, policy in config.items()}
@@ -0,0 +1,202 @@
+import json
+import time
+
+
+class IncrementalJSONParser:
+    """
+    Parses a JSON object as its text arrives in pieces.
+    Each top-level field is returned as soon as its value is complete, before the rest of the object has arrived.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        # The start of the top-level field currently being read
+        self.field_start = None
+        self.fields = {}
+        self.complete = False
+        # Set if the text is not valid JSON, parsing then stops and the text is left to be handled as a whole
+        self.failed = False
+
+    def feed(self, text: str) -> list[tuple[str, object]]:
+        """
+        Adds the next piece of the text.
+        :param text: the next piece of the text
+        :return: the top-level fields completed by this piece, as (name, value) pairs
+        """
+        self.buffer += text
+        completed = []
+        while self.position < len(self.buffer) and not self.complete and not self.failed:
+            char = self.buffer[self.position]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.field_start = self.position + 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    completed += self._end_field()
+                    self.complete = True
+            elif char == "," and self.depth == 1:
+                completed += self._end_field()
+                self.field_start = self.position + 1
+            self.position += 1
+        return completed
+
+    def _end_field(self) -> list[tuple[str, object]]:
+        """
+        Parses the top-level field that ends at the current position.
+        :return: the field as a (name, value) pair, or nothing if there was no field
+        """
+        text = self.buffer[self.field_start:self.position]
+        if not text.strip():
+            return []
+        try:
+            field = json.loads("{" + text + "}")
+        except ValueError:
+            self.failed = True
+            return []
+        self.fields.update(field)
+        return list(field.items())
+
+
+class StreamAssembler:
+    """
+    Assembles the chunks of a streamed chat completion back into a single message.
+    Content deltas are concatenated, the deltas of each function or tool call are merged into whole calls,
+    and the time to the first token and the generation speed are recorded.
+    The arguments of each call are parsed as they arrive, so each argument is available as soon as it is complete.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.finished = None
+        # Every content or argument delta holds a single token
+        self.tokens = 0
+        self.role = "assistant"
+        self.content = ""
+        # The calls in the order they were started, a legacy function call is the only call and has no id
+        self.calls = []
+        # The (call index, argument name, value) of the arguments completed by the last chunk
+        self.new_arguments = []
+        # The indices of the calls whose arguments were completed by the last chunk
+        self.completed_calls = []
+        self.finish_reason = None
+
+    def add(self, chunk: dict) -> dict:
+        """
+        Adds a streamed chunk to the message.
+        :param chunk: the chunk, as returned by the streaming completion
+        :return: the delta of the chunk
+        """
+        choice = chunk["choices"][0]
+        delta = choice.get("delta", {})
+        self.new_arguments = []
+        self.completed_calls = []
+        if delta.get("role"):
+            self.role = delta["role"]
+        if delta.get("content"):
+            self._token()
+            self.content += delta["content"]
+        if delta.get("function_call"):
+            self._add_call_delta(0, None, delta["function_call"])
+        for tool_call in delta.get("tool_calls") or []:
+            self._add_call_delta(tool_call["index"], tool_call.get("id"), tool_call.get("function", {}))
+        if choice.get("finish_reason"):
+            self.finish_reason = choice["finish_reason"]
+            self.finished = time.perf_counter()
+        return delta
+
+    def _add_call_delta(self, index: int, call_id: str | None, function: dict):
+        """
+        Adds the delta of a single call.
+        :param index: the index of the call
+        :param call_id: the id of the call, only sent with its first delta
+        :param function: the name and arguments delta of the call
+        """
+        while len(self.calls) <= index:
+            self.calls.append({"id": None, "name": "", "arguments": "", "parser": IncrementalJSONParser()})
+        call = self.calls[index]
+        if call_id:
+            call["id"] = call_id
+        if function.get("name"):
+            call["name"] += function["name"]
+        if function.get("arguments"):
+            self._token()
+            call["arguments"] += function["arguments"]
+            was_complete = call["parser"].complete
+            for argument, value in call["parser"].feed(function["arguments"]):
+                self.new_arguments.append((index, argument, value))
+            if call["parser"].complete and not was_complete:
+                self.completed_calls.append(index)
+
+    @property
+    def arguments_complete(self) -> bool:
+        """
+        Whether the arguments of every call started so far have been fully received.
+        """
+        return bool(self.calls) and all(call["parser"].complete for call in self.calls)
+
+    def call(self, index: int) -> dict:
+        """
+        Get a call in the same format as in a non-streamed message.
+        :param index: the index of the call
+        :return: the call
+        """
+        call = self.calls[index]
+        function = {"name": call["name"], "arguments": call["arguments"]}
+        if call["id"] is None:
+            return function
+        return {"id": call["id"], "type": "function", "function": function}
+
+    def finish(self):
+        """
+        Marks the stream as finished, for when it is not read to the end.
+        """
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    def _token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.tokens += 1
+
+    def message(self) -> dict:
+        """
+        Get the assembled message, in the same format as a message from a non-streamed completion.
+        :return: the message
+        """
+        message = {"role": self.role, "content": self.content or None}
+        if self.calls and self.calls[0]["id"] is None:
+            message["function_call"] = self.call(0)
+        elif self.calls:
+            message["tool_calls"] = [self.call(index) for index in range(len(self.calls))]
+        return message
+
+    def stats(self) -> dict:
+        """
+        Get the timing of the stream.
+        :return: the time to the first token and total time in seconds, the number of tokens and tokens per second
+        """
+        finished = self.finished or time.perf_counter()
+        first_token = self.first_token or finished
+        generation = finished - first_token
+        return {
+            "time_to_first_token": round(first_token - self.started, 3),
+            "total_time": round(finished - self.started, 3),
+            "tokens": self.tokens,
+            "tokens_per_second": round(self.tokens / generation, 1) if generation > 0 else None,
+        }
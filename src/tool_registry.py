@@ -0,0 +1,186 @@
+import re
+import json
+import math
+import yaml
+from src.gpt_function import GPTFunction
+
+# Words too common in prompts and descriptions to tell the functions apart
+_STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "with", "by", "from", "at", "as", "is", "are",
+    "be", "it", "this", "that", "these", "those", "if", "then", "else", "not", "no", "yes", "do", "does", "can",
+    "use", "used", "using", "will", "would", "should", "must", "you", "your", "i", "me", "my", "we", "what",
+    "which", "how", "all", "any", "some", "function", "functions", "step", "okay", "please", "whatever",
+    "necessary", "complete", "doing", "present", "tense", "ing", "ending", "always", "required",
+}
+
+
+def _terms(text: str) -> list[str]:
+    """
+    Splits a text into lowercase terms for the index, dropping common words and plural endings.
+    Names like get_travel_distance are split into their words.
+    :param text: the text
+    :return: the terms
+    """
+    terms = []
+    for word in re.findall(r"[a-z0-9]+", (text or "").lower().replace("_", " ")):
+        if word in _STOPWORDS or len(word) < 2:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        terms.append(word)
+    return terms
+
+
+class ToolRegistry:
+    """
+    Holds the functions available to the LLM, with their schemas serialized once and their token counts.
+    Selects the functions relevant to each request with a BM25 index over their names, descriptions and
+    configured keywords, so that only those schemas are sent.
+    Functions that must always be available, and those called recently, are always included,
+    on top of the ranked ones. Ranked functions scoring far below the best match are left out.
+    If nothing in the query matches any function well, every function is sent rather than a guess.
+    """
+
+    def __init__(self, functions: list[GPTFunction], count: callable, max_ranked: int = 8, always: list = None,
+                 query_messages: int = 2, enabled: bool = True, keywords: dict = None, min_score: float = 0.0,
+                 min_relative_score: float = 0.0):
+        self.functions = {function.name: function for function in functions}
+        self.max_ranked = max_ranked
+        self.min_score = min_score
+        self.min_relative_score = min_relative_score
+        self.always = [name for name in always or [] if name in self.functions]
+        keywords = keywords or {}
+        self.query_messages = query_messages
+        self.enabled = enabled
+        self.schemas = {}
+        self.tools = {}
+        self.tokens = {}
+        # name -> {term: frequency}, and the length of each document in terms
+        self.documents = {}
+        self.lengths = {}
+        for name, function in self.functions.items():
+            schema = function.to_dict()
+            self.schemas[name] = schema
+            self.tools[name] = {"type": "function", "function": schema}
+            self.tokens[name] = count(json.dumps(schema))
+            text = " ".join([name, function.description, keywords.get(name, "")] + [
+                f"{argument} {prop.get('description', '')}" for argument, prop in function.properties.items()
+                if argument != "reason"
+            ])
+            document = {}
+            for term in _terms(text):
+                document[term] = document.get(term, 0) + 1
+            self.documents[name] = document
+            self.lengths[name] = sum(document.values())
+        self.average_length = sum(self.lengths.values()) / max(len(self.lengths), 1)
+        self.idf = {}
+        for document in self.documents.values():
+            for term in document:
+                self.idf[term] = self.idf.get(term, 0) + 1
+        total = len(self.documents)
+        for term, frequency in self.idf.items():
+            self.idf[term] = math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+
+    def score(self, query: str) -> dict:
+        """
+        Scores every function against a query with BM25.
+        :param query: the query text
+        :return: the score of each function, by name
+        """
+        k1, b = 1.2, 0.75
+        terms = set(_terms(query))
+        scores = {}
+        for name, document in self.documents.items():
+            score = 0.0
+            norm = k1 * (1 - b + b * self.lengths[name] / self.average_length)
+            for term in terms:
+                frequency = document.get(term, 0)
+                if frequency:
+                    score += self.idf[term] * frequency * (k1 + 1) / (frequency + norm)
+            scores[name] = score
+        return scores
+
+    def _recent(self, messages: list) -> tuple[str, set]:
+        """
+        Gets the query for a request, and the functions called recently.
+        The query is the text of the last few user messages, or system prompts after the first, as agents use them.
+        :param messages: the messages of the conversation
+        :return: the query and the names of the functions called since the first message in it
+        """
+        starts = [index for index, message in enumerate(messages)
+                  if index > 0 and message["role"] in ("user", "system")][-self.query_messages:]
+        if not starts:
+            return "", set()
+        query = " ".join(messages[index].get("content") or "" for index in starts)
+        called = set()
+        for message in messages[starts[0]:]:
+            if message.get("function_call"):
+                called.add(message["function_call"]["name"])
+            for call in message.get("tool_calls") or []:
+                called.add(call["function"]["name"])
+        return query, called
+
+    def select(self, messages: list) -> list[str]:
+        """
+        Selects the functions to send with a request.
+        :param messages: the messages of the conversation
+        :return: the names of the selected functions, in the order they were registered
+        """
+        if not self.enabled or len(self.functions) <= len(self.always) + self.max_ranked:
+            return list(self.functions)
+        query, called = self._recent(messages)
+        scores = self.score(query)
+        best = max(scores.values(), default=0.0)
+        # A weak best match says little about which functions are needed
+        if best <= 0 or best < self.min_score:
+            return list(self.functions)
+        selected = set(self.always) | (called & set(self.functions))
+        ranked = sorted((name for name in scores if name not in selected and scores[name] > 0 and
+                         scores[name] >= self.min_relative_score * best), key=lambda name: -scores[name])
+        selected.update(ranked[:self.max_ranked])
+        return [name for name in self.functions if name in selected]
+
+    def function_schemas(self, names: list[str]) -> list[dict]:
+        """
+        Get the schemas of functions in the legacy function calling format.
+        :param names: the names of the functions
+        :return: the schemas
+        """
+        return [self.schemas[name] for name in names]
+
+    def tool_schemas(self, names: list[str]) -> list[dict]:
+        """
+        Get the schemas of functions in the tools format.
+        :param names: the names of the functions
+        :return: the schemas
+        """
+        return [self.tools[name] for name in names]
+
+    def count(self, names: list[str]) -> int:
+        """
+        Get the tokens the schemas of functions take up in a request.
+        :param names: the names of the functions
+        :return: the number of tokens
+        """
+        return sum(self.tokens[name] for name in names)
+
+
+def get_tool_registry(functions: list[GPTFunction], count: callable) -> ToolRegistry:
+    """
+    Creates a tool registry for a set of functions, configured from the config.
+    :param functions: the functions
+    :param count: a function counting the tokens in a text
+    :return: the tool registry
+    """
+    config = yaml.safe_load(open("config.yaml", "r"))["tools"]
+    return ToolRegistry(
+        functions,
+        count,
+        max_ranked=config["max_ranked"],
+        always=config["always"],
+        query_messages=config["query_messages"],
+        enabled=config["select"],
+        keywords=config["keywords"],
+        min_score=config["min_score"],
+        min_relative_score=config["min_relative_score"],
+    )
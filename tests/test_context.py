@@ -0,0 +1,86 @@
+import json
+import pytest
+from src.context import ContextManager, ContextOverflow
+
+
+def _turn(index: int, result_words: int = 0) -> list:
+    messages = [{"role": "user", "content": f"question {index} " * 10}]
+    if result_words:
+        messages.append({"role": "assistant", "content": None,
+                         "function_call": {"name": "get_weather", "arguments": json.dumps({"day": index})}})
+        messages.append({"role": "function", "name": "get_weather", "content": "sunny and warm " * result_words})
+    messages.append({"role": "assistant", "content": f"answer {index} " * 10})
+    return messages
+
+
+def _history(turns: list) -> list:
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in turns:
+        messages += turn
+    return messages
+
+
+def _used(manager: ContextManager, messages: list) -> int:
+    return sum(manager.count(message) for message in messages)
+
+
+def test_fits_without_changes_under_budget():
+    manager = ContextManager("gpt-3.5-turbo", budget=10000)
+    messages = _history([_turn(0, 50), _turn(1)])
+    original = [dict(message) for message in messages]
+    assert manager.fit(messages) == original
+
+
+def test_older_results_are_shortened_before_turns_are_dropped():
+    manager = ContextManager("gpt-3.5-turbo", budget=600, keep_recent_turns=1, truncate_tokens=20)
+    messages = _history([_turn(0, 300), _turn(1), _turn(2)])
+    sent = manager.fit(messages)
+    assert _used(manager, sent) <= 600
+    assert len(messages) == 9
+    assert "truncated" in messages[3]["content"]
+
+
+def test_older_turns_are_dropped_from_the_start():
+    manager = ContextManager("gpt-3.5-turbo", budget=150, keep_recent_turns=1)
+    turns = [_turn(index) for index in range(5)]
+    messages = _history(turns + [[{"role": "user", "content": "new question"}]])
+    sent = manager.fit(messages)
+    assert _used(manager, sent) <= 150
+    assert messages[0]["role"] == "system"
+    assert messages[-1]["content"] == "new question"
+    assert messages[-3:-1] == turns[-1]
+
+
+def test_large_results_in_recent_turns_are_shortened():
+    manager = ContextManager("gpt-3.5-turbo", budget=400, keep_recent_turns=1, truncate_tokens=50)
+    messages = _history([_turn(0), _turn(1, 300)])
+    question = dict(messages[3])
+    sent = manager.fit(messages)
+    assert _used(manager, sent) <= 400
+    # The older turn goes first, then the result of the recent one is shortened
+    assert messages[1] == question
+    assert "truncated" in messages[3]["content"]
+
+
+def test_recent_turns_are_dropped_before_the_last():
+    manager = ContextManager("gpt-3.5-turbo", budget=60, keep_recent_turns=3)
+    messages = _history([_turn(0), _turn(1), [{"role": "user", "content": "new question"}]])
+    sent = manager.fit(messages)
+    assert _used(manager, sent) <= 60
+    assert [message["content"] for message in messages[1:]] == ["new question"]
+
+
+def test_extra_messages_and_functions_count_towards_the_budget():
+    manager = ContextManager("gpt-3.5-turbo", budget=300, keep_recent_turns=1)
+    messages = _history([_turn(index) for index in range(4)])
+    extra = [{"role": "system", "content": "Data available from storage: none"}]
+    sent = manager.fit(messages, extra, function_tokens=100)
+    assert sent[-1] == extra[0]
+    assert _used(manager, sent) + 100 <= 300
+
+
+def test_raises_when_the_request_cannot_fit():
+    manager = ContextManager("gpt-3.5-turbo", budget=50)
+    messages = _history([[{"role": "user", "content": "a very long question " * 100}]])
+    with pytest.raises(ContextOverflow):
+        manager.fit(messages)
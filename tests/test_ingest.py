@@ -0,0 +1,62 @@
+import io
+import numpy as np
+import pandas as pd
+from data.ingest import optimize_dtypes, read_csv_chunked
+
+
+def test_numbers_are_kept_by_default():
+    data = pd.DataFrame({"price": [100000, 120000], "qty": [50000, 50000], "rate": [0.1, 0.2]})
+    optimized, report = optimize_dtypes(data)
+    assert report["converted"] == {}
+    assert (optimized["price"] * optimized["qty"]).tolist() == [5000000000, 6000000000]
+    assert optimized["rate"].dtype == np.float64
+
+
+def test_downcast_numbers_round_trip():
+    data = pd.DataFrame({
+        "small": [1, -2, 3],
+        "large": [1, 2, 2 ** 40],
+        "nullable": pd.array([1, None, 3], dtype="Int64"),
+        "exact": [0.5, 1.25, np.nan],
+        "inexact": [0.1, 0.2, 0.3],
+    })
+    optimized, report = optimize_dtypes(data, downcast_numbers=True)
+    assert optimized["small"].dtype == np.int32
+    assert optimized["large"].dtype == np.int64
+    assert optimized["nullable"].dtype == "Int32"
+    assert optimized["exact"].dtype == np.float32
+    assert optimized["inexact"].dtype == np.float64
+    for name in data.columns:
+        pd.testing.assert_series_equal(optimized[name].astype(data[name].dtype), data[name])
+
+
+def test_dates_need_an_unambiguous_format():
+    data = pd.DataFrame({
+        "day_first": ["03/04/2023", "25/12/2023"],
+        "month_first": ["03/04/2023", "12/25/2023"],
+        "ambiguous": ["03/04/2023", "04/05/2023"],
+        "iso": ["2023-01-05 10:00", "2023-02-05 11:30"],
+        "not_dates": ["2023-01-05", "2023-01-05 and more"],
+    })
+    optimized, _ = optimize_dtypes(data)
+    assert optimized["day_first"].tolist() == [pd.Timestamp("2023-04-03"), pd.Timestamp("2023-12-25")]
+    assert optimized["month_first"].tolist() == [pd.Timestamp("2023-03-04"), pd.Timestamp("2023-12-25")]
+    assert optimized["ambiguous"].dtype == object
+    assert optimized["iso"].tolist() == [pd.Timestamp("2023-01-05 10:00"), pd.Timestamp("2023-02-05 11:30")]
+    assert optimized["not_dates"].dtype == object
+
+
+def test_strings_stay_strings_unless_categories_are_enabled():
+    data = pd.DataFrame({"city": ["London", "Paris"] * 10})
+    assert optimize_dtypes(data)[0]["city"].dtype == object
+    assert isinstance(optimize_dtypes(data, categories=True)[0]["city"].dtype, pd.CategoricalDtype)
+
+
+def test_read_csv_chunked_keeps_values_across_chunks():
+    rows = ["a,b"] + [f"{i},{i * 0.5}" for i in range(250)] + ["5000000000,0.1", ","]
+    file = io.BytesIO("\n".join(rows).encode())
+    data = read_csv_chunked(file, chunk_rows=100, sample_rows=50, downcast=True)
+    assert len(data) == 252
+    assert data["a"].iloc[-2] == 5000000000
+    assert pd.isna(data["a"].iloc[-1])
+    assert data["b"].iloc[-2] == 0.1
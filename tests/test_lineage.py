@@ -0,0 +1,105 @@
+import pandas as pd
+import pytest
+from data.lineage import Lineage
+
+TRANSFORMATIONS = {
+    "double": lambda data: data.assign(a=data["a"] * 2),
+    "add_one": lambda data: data.assign(a=data["a"] + 1),
+    "drop_first": lambda data: data.iloc[1:].reset_index(drop=True),
+}
+
+
+class Recompute:
+    """
+    Reruns the transformations by name instead of on a worker, and records which ones it ran.
+    """
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.ran = []
+
+    def __call__(self, node: dict, data: pd.DataFrame) -> pd.DataFrame:
+        if self.fail:
+            raise RuntimeError("Could not recompute")
+        self.ran.append(node["code"])
+        return TRANSFORMATIONS[node["code"]](data)
+
+
+def _lineage(budget_mb: float, codes: list) -> tuple[Lineage, list]:
+    versions = [pd.DataFrame({"a": [1, 2, 3]})]
+    lineage = Lineage(versions[0], "numbers", budget_mb=budget_mb)
+    for code in codes:
+        versions.append(TRANSFORMATIONS[code](versions[-1]))
+        lineage.append(versions[-1], code=code, result_name="df")
+    return lineage, versions
+
+
+@pytest.fixture
+def lineages():
+    created = []
+    yield created
+    for lineage in created:
+        lineage.close()
+
+
+def test_undo_returns_to_the_parent(lineages):
+    lineage, versions = _lineage(1024, ["double", "add_one"])
+    lineages.append(lineage)
+    recompute = Recompute()
+    assert lineage.undo(recompute)
+    pd.testing.assert_frame_equal(lineage.data, versions[1])
+    assert lineage.undo(recompute)
+    pd.testing.assert_frame_equal(lineage.data, versions[0])
+    # The original version is never removed
+    assert not lineage.undo(recompute)
+    assert len(lineage) == 1
+    # All the versions were kept, so nothing was recomputed
+    assert recompute.ran == []
+
+
+def test_evicted_versions_are_recomputed_from_the_closest_kept_ancestor(lineages):
+    lineage, versions = _lineage(0, ["double", "add_one", "drop_first"])
+    lineages.append(lineage)
+    # Only the original and the head fit in the budget
+    assert [lineage.store.has(node["version"]) for node in lineage.nodes] == [True, False, False, True]
+
+    recompute = Recompute()
+    assert lineage.undo(recompute)
+    pd.testing.assert_frame_equal(lineage.data, versions[2])
+    assert recompute.ran == ["double", "add_one"]
+    assert lineage.head["code"] == "add_one"
+
+    recompute = Recompute()
+    assert lineage.undo(recompute)
+    pd.testing.assert_frame_equal(lineage.data, versions[1])
+    assert recompute.ran == ["double"]
+
+
+def test_materialize_keeps_only_the_requested_version(lineages):
+    lineage, versions = _lineage(0, ["double", "add_one", "drop_first"])
+    lineages.append(lineage)
+    recompute = Recompute()
+    pd.testing.assert_frame_equal(lineage.materialize(2, recompute), versions[2])
+    assert [lineage.store.has(node["version"]) for node in lineage.nodes] == [True, False, True, True]
+    # The kept version is used directly the next time
+    recompute.ran = []
+    pd.testing.assert_frame_equal(lineage.materialize(2, recompute), versions[2])
+    assert recompute.ran == []
+
+
+def test_failed_recompute_leaves_the_history_unchanged(lineages):
+    lineage, versions = _lineage(0, ["double", "add_one"])
+    lineages.append(lineage)
+    head = lineage.head["version"]
+    with pytest.raises(RuntimeError):
+        lineage.undo(Recompute(fail=True))
+    assert len(lineage) == 3
+    assert lineage.head["version"] == head
+    pd.testing.assert_frame_equal(lineage.data, versions[2])
+
+
+def test_close_releases_the_data():
+    lineage, _ = _lineage(1024, ["double"])
+    versions = [node["version"] for node in lineage.nodes]
+    lineage.close()
+    assert not any(lineage.store.has(version) for version in versions)
@@ -0,0 +1,75 @@
+import json
+from src.streaming import IncrementalJSONParser
+
+
+def _feed(text: str, size: int = 1) -> tuple[IncrementalJSONParser, list]:
+    parser = IncrementalJSONParser()
+    completed = []
+    for start in range(0, len(text), size):
+        completed.append(parser.feed(text[start:start + size]))
+    return parser, completed
+
+
+def test_fields_are_returned_as_soon_as_they_are_complete():
+    text = '{"data_name": "sales", "code": "df = df.dropna()"}'
+    parser, completed = _feed(text)
+    # The first field completes at the comma, the second at the closing brace
+    assert completed[text.index(",")] == [("data_name", "sales")]
+    assert completed[-1] == [("code", "df = df.dropna()")]
+    assert parser.complete and not parser.failed
+    assert parser.fields == json.loads(text)
+
+
+def test_strings_with_escapes_and_brackets():
+    value = 'print("a, b") # {not} [nested] \\" \\\\ é'
+    text = json.dumps({"code": value, "next": 1})
+    for size in (1, 2, 3, len(text)):
+        parser, completed = _feed(text, size)
+        assert [field for fields in completed for field in fields] == [("code", value), ("next", 1)]
+        assert parser.complete and not parser.failed
+
+
+def test_unicode_escapes_are_decoded():
+    text = '{"city": "M\\u00fcnchen", "emoji": "\\ud83d\\ude00"}'
+    parser, _ = _feed(text, 4)
+    assert parser.fields == {"city": "München", "emoji": "\U0001F600"}
+
+
+def test_nested_values_and_literals():
+    text = '{"filters": {"a": [1, 2, {"b": "}"}]}, "limit": 10, "ratio": -1.5e3, ' \
+           '"flag": true, "other": false, "none": null, "list": []}'
+    parser, completed = _feed(text)
+    names = [name for fields in completed for name, _ in fields]
+    assert names == ["filters", "limit", "ratio", "flag", "other", "none", "list"]
+    assert parser.fields == json.loads(text)
+
+
+def test_whitespace_and_empty_objects():
+    parser, completed = _feed('  \n{ }')
+    assert parser.complete and parser.fields == {}
+    assert all(fields == [] for fields in completed)
+
+    parser, _ = _feed('{\n  "a" : 1 ,\n  "b" : "x"\n}\n')
+    assert parser.fields == {"a": 1, "b": "x"}
+
+
+def test_text_after_the_object_is_ignored():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"a": 1}{"b": 2}') == [("a", 1)]
+    assert parser.feed(', "c": 3}') == []
+    assert parser.fields == {"a": 1}
+
+
+def test_incomplete_object_is_not_complete():
+    parser, completed = _feed('{"a": 1, "b": "unfinished')
+    assert completed[-1] == []
+    assert parser.fields == {"a": 1}
+    assert not parser.complete and not parser.failed
+
+
+def test_invalid_json_stops_parsing():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"a": 1, b: 2, "c": 3}') == [("a", 1)]
+    assert parser.failed and not parser.complete
+    assert parser.feed('"more"') == []
+    assert parser.fields == {"a": 1}
@@ -0,0 +1,55 @@
+import pandas as pd
+import pytest
+from data.workers import WorkerPool
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(size=1)
+    yield pool
+    pool.shutdown()
+
+
+CHANGE_STATE = """
+import os
+pd.set_option("display.precision", 1)
+np.seterr(all="raise")
+os.environ["DATAGPT_TEST"] = "1"
+with open("user_helper.py", "w") as f:
+    f.write("VALUE = 1")
+sys.path.insert(0, os.getcwd())
+import user_helper
+os.chdir("/")
+"""
+
+READ_STATE = """
+import os
+print(pd.get_option("display.precision"), np.geterr()["divide"], os.environ.get("DATAGPT_TEST"),
+      "user_helper" in sys.modules, os.getcwd() == workdir)
+"""
+
+
+def test_global_state_is_restored_after_each_job(pool, tmp_path):
+    data = pd.DataFrame({"a": [1.5, 2.5]})
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+    output = pool.run("session", str(first), "import sys\n" + CHANGE_STATE, "data", data, "v1")
+    assert output["exit_reason"] == "ok", output["stderr"]
+
+    code = f"import sys\nworkdir = {str(second)!r}\n" + READ_STATE
+    output = pool.run("session", str(second), code, "data", data, "v1")
+    assert output["exit_reason"] == "ok", output["stderr"]
+    assert output["stdout"].split() == ["6", "warn", "None", "False", "True"]
+
+
+def test_workers_are_replaced_between_sessions(pool, tmp_path):
+    data = pd.DataFrame({"a": [1]})
+    pool.run("first", str(tmp_path), "pd.DataFrame.patched = True", "data", data, "v1")
+    worker = pool.workers[0]
+    pool.run("first", str(tmp_path), "print(hasattr(pd.DataFrame, 'patched'))", "data", data, "v1")
+    assert pool.workers[0] is worker
+
+    output = pool.run("second", str(tmp_path), "print(hasattr(pd.DataFrame, 'patched'))", "data", data, "v1")
+    assert pool.workers[0] is not worker
+    assert output["stdout"].strip() == "False"